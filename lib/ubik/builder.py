@@ -13,46 +13,174 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import ConfigParser
 import copy
+import errno
+import hashlib
 import logging
 import os, os.path
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 import urllib
 
+import ubik.cache
 import ubik.config
 
 log = logging.getLogger('ubik.builder')
 
 # module will be called if '[module name]' section exists in package's
-# config file.  Order probably matters here.
+# config file.  Modules run phase by phase in the order below, and each phase
+# finishes before the next starts.  Consecutive modules marked concurrent
+# run at the same time.  Modules that use fabric's lcd() can't be concurrent
+# because fabric's env is shared between threads, and modules that write to
+# the same paths as others in their phase (copy's rsync --delete into the
+# source tree, symlinks' makedirs) can't be either.
+PHASES = ('prepare', 'source', 'build', 'post')
 build_modules = [
-    # module name, python name, function to call
-    ['buildrequires', 'ubik.fab.buildrequires', 'check_build_reqs'],
+    # module name, python name, function to call, phase, concurrent
+    ['buildrequires', 'ubik.fab.buildrequires', 'check_build_reqs',
+     'prepare', False],
     # Source creation modules
-    ['git', 'ubik.fab.git', 'clone'],
-    ['svn', 'ubik.fab.svn', 'checkout'],
+    ['git', 'ubik.fab.git', 'clone', 'source', True],
+    ['svn', 'ubik.fab.svn', 'checkout', 'source', True],
     # Source and/or build modules
-    ['tgz', 'ubik.fab.tgz', 'untar'],
-    ['copy', 'ubik.fab.copy', 'copysrc'],
+    ['tgz', 'ubik.fab.tgz', 'untar', 'source', True],
+    ['copy', 'ubik.fab.copy', 'copysrc', 'source', False],
     # Primary build modules
-    ['ant', 'ubik.fab.ant', 'build'],
-    ['fab', 'ubik.fab.fab', 'build'],
-    ['make', 'ubik.fab.make', 'build'],
-    ['maven', 'ubik.fab.maven', 'build'],
-    ['distutils', 'ubik.fab.distutils', 'build'],
-    ['pip', 'ubik.fab.pip', 'build'],
+    ['ant', 'ubik.fab.ant', 'build', 'build', False],
+    ['fab', 'ubik.fab.fab', 'build', 'build', False],
+    ['make', 'ubik.fab.make', 'build', 'build', False],
+    ['maven', 'ubik.fab.maven', 'build', 'build', False],
+    ['distutils', 'ubik.fab.distutils', 'build', 'build', False],
+    ['pip', 'ubik.fab.pip', 'build', 'build', False],
     # Post processing modules
-    ['jettypathhack', 'ubik.fab.jettypathhack', 'hackthepath'],
-    ['monit', 'ubik.fab.monit', 'write_monit_config'],
-    ['supervisor', 'ubik.fab.supervisor', 'write_supervisor_config'],
-    ['symlinks', 'ubik.fab.symlinks', 'makelinks'],
+    ['jettypathhack', 'ubik.fab.jettypathhack', 'hackthepath', 'post', False],
+    ['monit', 'ubik.fab.monit', 'write_monit_config', 'post', True],
+    ['supervisor', 'ubik.fab.supervisor', 'write_supervisor_config',
+     'post', True],
+    ['symlinks', 'ubik.fab.symlinks', 'makelinks', 'post', False],
 ]
 
+def schedule(sections):
+    """Return the build modules needed for sections as a list of batches
+
+    Each batch is a list of [module name, python name, function, phase,
+    concurrent] entries that may run at the same time.  Batches must be run
+    in order.
+
+    >>> [[m[0] for m in b] for b in schedule(('git', 'tgz', 'make', 'pip'))]
+    [['git', 'tgz'], ['make'], ['pip']]
+    >>> [[m[0] for m in b] for b in schedule(('git', 'tgz', 'copy', 'make'))]
+    [['git', 'tgz'], ['copy'], ['make']]
+    >>> [[m[0] for m in b]
+    ...  for b in schedule(('symlinks', 'monit', 'supervisor'))]
+    [['monit', 'supervisor'], ['symlinks']]
+    >>>
+
+    """
+    batches = []
+    previous = None
+    by_phase = sorted(build_modules, key=lambda m: PHASES.index(m[3]))
+    for entry in by_phase:
+        if entry[0] not in sections:
+            continue
+        section, module, func, phase, concurrent = entry
+        if concurrent and previous == (phase, True):
+            batches[-1].append(entry)
+        else:
+            batches.append([entry])
+        previous = (phase, concurrent)
+    return batches
+
+def build_subdirs(config, config_vars=None):
+    """Return the source subdirectories that the build modules build from
+
+    This is the 'subdir' option of each configured build phase module.
+    Absolute subdirs don't refer to the source tree and are skipped.  An
+    empty list means the build uses the whole source tree.
+
+    >>> import ConfigParser
+    >>> config = ConfigParser.SafeConfigParser()
+    >>> config.add_section('make')
+    >>> config.set('make', 'subdir', 'src/c')
+    >>> config.add_section('maven')
+    >>> config.set('maven', 'subdir', '%(root)s/_src')
+    >>> build_subdirs(config, {'root': '/tmp/root'})
+    ['src/c']
+    >>>
+
+    """
+    subdirs = []
+    for name, module, func, phase, concurrent in build_modules:
+        if phase != 'build' or not config.has_option(name, 'subdir'):
+            continue
+        subdir = os.path.normpath(config.get(name, 'subdir',
+                                             vars=config_vars))
+        if os.path.isabs(subdir) or subdir.startswith('..'):
+            continue
+        if subdir != '.' and subdir not in subdirs:
+            subdirs.append(subdir)
+    return subdirs
+
+# Source modules need a way of identifying what they'll fetch without actually
+# fetching it for builds to be cached.  Builds using source modules that
+# are missing from this table are never cached.
+source_revisions = {
+    # module name: (python name, function to call)
+    'git': ('ubik.fab.git', 'revision'),
+    'svn': ('ubik.fab.svn', 'revision'),
+    'tgz': ('ubik.fab.tgz', 'revision'),
+}
+SOURCE_MODULES = ('copy', 'git', 'svn', 'tgz')
+
 class BuildError(Exception):
     pass
 
+class _ModuleThread(threading.Thread):
+    "Runs a build module function, saving any exception it raises"
+    def __init__(self, section, func, kwargs):
+        threading.Thread.__init__(self, name=section)
+        self.func = func
+        self.kwargs = kwargs
+        self.error = None
+        self.elapsed = None
+
+    def run(self):
+        start = time.time()
+        try:
+            self.func(**self.kwargs)
+        except BaseException:
+            # fabric's abort() raises SystemExit, which isn't an Exception
+            self.error = sys.exc_info()
+        self.elapsed = time.time() - start
+
 class BuildEnv(object):
+    """The directories a build uses, which are made when first used
+
+    Concurrent build modules may use the same directories at once.
+
+    >>> env = BuildEnv('tests/out/env/build', 'tests/out/env/root',
+    ...                'tests/out/env/src')
+    >>> def source(version, config, env):
+    ...     for i in range(100):
+    ...         env._mkdirreturn(os.path.join(env.srcdir, str(i), 'sub'))
+    >>> threads = [_ModuleThread(section, source,
+    ...                          {'version': '1.0', 'config': None, 'env': env})
+    ...            for section in ('git', 'svn', 'tgz')]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> for thread in threads:
+    ...     thread.join()
+    >>> [thread.error for thread in threads]
+    [None, None, None]
+    >>> len(os.listdir(env.srcdir))
+    100
+    >>>
+
+    """
     def __init__(self, builddir='_build', rootdir='_root', srcdir='.'):
         self._dirs = {
             'builddir': builddir,
@@ -80,7 +208,12 @@ class BuildEnv(object):
 
     def _mkdirreturn(self, dirname):
         if not os.path.exists(dirname):
-            os.makedirs(dirname)
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                # Another build module made it first
+                if e.errno != errno.EEXIST:
+                    raise
         return dirname
 
     def exists(self, dirname):
@@ -113,14 +246,98 @@ class Builder(object):
 
         log.info('Commence to build package ' + pkgcfg.get('package', 'name'))
         pkgcfg_modules = set(s.split(':', 1)[0] for s in pkgcfg.sections())
-        for section, module, buildfunc in build_modules:
-            if section in pkgcfg_modules:
+
+        build_cache = self._get_build_cache(pkgcfg)
+        cache_key = None
+        if build_cache:
+            cache_key = self._build_key(pkgcfg, pkgcfg_modules, version)
+        if cache_key and build_cache.restore(cache_key, self.env.rootdir):
+            log.info("Restored build %s from the build cache", cache_key)
+            return
+
+        timings = []
+        build_start = time.time()
+        kwargs = {'version': version, 'config': pkgcfg, 'env': self.env}
+        for batch in schedule(pkgcfg_modules):
+            threads = []
+            for section, module, buildfunc, phase, concurrent in batch:
                 log.info("Found %s section!  Importing the needful..." % section)
-                module_statement = ("import %s; %s.%s(version=version, "
-                    "config=pkgcfg, env=self.env)" %
-                    (module, module, buildfunc))
-                log.debug("Running statement: " + module_statement)
-                exec(module_statement)
+                func = getattr(__import__(module, fromlist=[buildfunc]),
+                               buildfunc)
+                threads.append(_ModuleThread(section, func, kwargs))
+
+            if len(threads) == 1:
+                # Run in this thread so that tracebacks stay intact
+                start = time.time()
+                threads[0].func(**kwargs)
+                threads[0].elapsed = time.time() - start
+            else:
+                log.debug("Running %s concurrently",
+                          ', '.join(t.name for t in threads))
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                for thread in threads:
+                    if thread.error:
+                        log.error("Build module %s failed", thread.name)
+                        raise thread.error[0], thread.error[1], thread.error[2]
+
+            for thread, entry in zip(threads, batch):
+                timings.append((entry[3], thread.name, thread.elapsed))
+
+        if timings:
+            log.info("Build module timings:")
+            for phase, section, elapsed in timings:
+                log.info("    %-8s %-16s %8.2fs", phase, section, elapsed)
+            log.info("    %-25s %8.2fs", 'total',
+                     time.time() - build_start)
+
+        if cache_key:
+            build_cache.store(cache_key, self.env.rootdir)
+
+    def _build_key(self, pkgcfg, pkgcfg_modules, version):
+        '''Return a digest of everything that goes into a build
+
+        The digest covers the version, the raw package config and the
+        revision that each source module would fetch.  Returns None when a
+        source can't be identified and so the build can't be cached.
+        '''
+        digest = hashlib.sha1()
+        digest.update('version=%s\n' % version)
+        for section in sorted(pkgcfg.sections()):
+            digest.update('[%s]\n' % section)
+            for option, value in sorted(pkgcfg.items(section, raw=True)):
+                digest.update('%s=%s\n' % (option, value))
+
+        for section in sorted(pkgcfg_modules.intersection(SOURCE_MODULES)):
+            if section not in source_revisions:
+                log.info("Builds using %s cannot be cached", section)
+                return None
+            module, func = source_revisions[section]
+            revision = getattr(__import__(module, fromlist=[func]), func)(
+                version=version, config=pkgcfg, env=self.env)
+            if not revision:
+                return None
+            log.debug("%s source revision is %s", section, revision)
+            digest.update('%s=%s\n' % (section, revision))
+
+        return digest.hexdigest()
+
+    def _get_build_cache(self, pkgcfg):
+        '''Return a ubik.cache.UbikBuildCache if enabled by config'''
+        try:
+            enabled = pkgcfg.get('builder', 'cache')
+        except ConfigParser.Error:
+            return None
+        if enabled.lower() not in ('true', 'yes', '1'):
+            return None
+        try:
+            link = pkgcfg.get('builder', 'cache_link')
+        except ConfigParser.Error:
+            link = 'reflink'
+        return ubik.cache.UbikBuildCache(pkgcfg.get('builder', 'cache_dir'),
+                                         link)
 
     def clean(self):
         if self.env.exists('builddir'):
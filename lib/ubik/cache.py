@@ -15,24 +15,203 @@
 #
 "Utilities for caching files in directory"
 
+import errno
+import fcntl
 import logging
 import mimetypes
+import multiprocessing
 import os, os.path
+import re
 import sqlite3
 import shutil
 import subprocess
+import tarfile
+import tempfile
+import time
+
+import ubik.debfile
+import ubik.rpmfile
 
 log = logging.getLogger('ubik.cache')
 
 INSPECT_CMD_TAB = {
     'deb': ('dpkg-deb', '--showformat',
             '${Package}\t${Architecture}\t${Version}', '--show'),
-    'rpm': ('rpm', '-q', '--qf', '%{NAME}\t%{ARCH}\t%{VERSION}', '-p'),
+    'rpm': ('rpm', '-q', '--qf',
+            '%{NAME}\t%{ARCH}\t%{VERSION}\t%{RELEASE}\t%{EPOCH}', '-p'),
 }
+# Fields output by INSPECT_CMD_TAB.  rpm versions don't include the release
+# and epoch, which are kept separately.
+INSPECT_FIELDS = ('name', 'arch', 'version', 'release', 'epoch')
+
+# ioctl to share the data blocks of a file (a reflink) on Linux
+FICLONE = 0x40049409
+# Index schema changes are applied by UbikPackageCache._migrate()
+SCHEMA_VERSION = 3
+GLOB_CHARS = re.compile(r'[*?[]')
+# How prune() ranks the packages in each (name, type, arch) group, newest
+# first.  Window functions need sqlite 3.25, so older versions count the
+# newer packages in the group instead.
+if sqlite3.sqlite_version_info >= (3, 25, 0):
+    PRUNE_RANK = ('ROW_NUMBER() OVER (PARTITION BY name, type, arch '
+                  'ORDER BY version_key DESC, added DESC, rowid DESC)')
+else:
+    PRUNE_RANK = ('(SELECT COUNT(*) + 1 FROM packages q '
+                  'WHERE q.name = p.name AND q.type = p.type '
+                        'AND q.arch = p.arch '
+                        'AND (q.version_key > p.version_key '
+                             'OR (q.version_key = p.version_key '
+                                 'AND (q.added > p.added '
+                                      'OR (q.added = p.added '
+                                          'AND q.rowid > p.rowid)))))')
+# Rows inserted per transaction by bulk imports
+INSERT_BATCH = 1000
+# Replacing a package keeps it pinned, see UbikPackageCache.pin()
+REPLACE_SQL = ('REPLACE INTO packages '
+               '(name, version, type, arch, filename, version_key, added, '
+                'size, accessed, pinned) '
+               'VALUES (:name, :version, :type, :arch, :filename, '
+                       ':version_key, COALESCE(:added, CURRENT_TIMESTAMP), '
+                       ':size, '
+                       'COALESCE(:accessed, :added, CURRENT_TIMESTAMP), '
+                       'COALESCE(:pinned, (SELECT pinned FROM packages '
+                                          'WHERE filename = :filename), 0));')
+RPM_VERSION_TOKENS = re.compile(r'~|\^|[0-9]+|[A-Za-z]+')
 
 class CacheException(Exception):
     pass
 
+def _number_key(digits):
+    "Return a string that sorts like the integer digits"
+    digits = digits.lstrip('0')
+    return '%02d%s' % (len(digits), digits)
+
+def _split_version(version):
+    "Split version into epoch, version and release/revision"
+    epoch = '0'
+    if ':' in version:
+        epoch, version = version.split(':', 1)
+        if not epoch.isdigit():
+            epoch = '0'
+    release = ''
+    if '-' in version:
+        version, release = version.rsplit('-', 1)
+    return epoch, version, release
+
+def _deb_part_key(part):
+    """Return a string that sorts like part of a version does in dpkg
+
+    dpkg compares alternating non-digit and digit runs.  Non-digits compare
+    by character, where '~' sorts before anything, even the end of the run,
+    and letters sort before other characters.  Digit runs compare as
+    numbers.
+    """
+    key = []
+    runs = [r for r in re.findall(r'([^0-9]*)([0-9]*)', part) if r != ('', '')]
+    for nondigits, digits in runs or [('', '')]:
+        for c in nondigits:
+            if c == '~':
+                key.append('000')
+            elif c.isalpha():
+                key.append('%03x' % (ord(c) + 2))
+            else:
+                key.append('%03x' % (ord(c) + 258))
+        key.append('001')
+        key.append(_number_key(digits))
+    # The end of a version sorts after '~' but before anything else
+    key.append('001')
+    return ''.join(key)
+
+def _rpm_part_key(part):
+    """Return a string that sorts like part of a version does in rpm
+
+    rpm compares alphabetic and numeric segments, ignoring separators.
+    Numeric segments are newer than alphabetic ones, and more segments are
+    newer than fewer.  '~' sorts before the end of a version and '^' sorts
+    after it but before any other segment.
+    """
+    key = []
+    for token in RPM_VERSION_TOKENS.findall(part):
+        if token == '~':
+            key.append('0')
+        elif token == '^':
+            key.append('3')
+        elif token.isdigit():
+            key.append('5' + _number_key(token))
+        else:
+            key.append('4' + token + '!')
+    key.append('2')
+    return ''.join(key)
+
+def version_key(version, pkg_type=None):
+    """Return a string that sorts versions the way the package manager would
+
+    rpm packages are ordered like rpm does, and everything else like dpkg.
+
+    >>> sorted(['1.10', '1.9', '1:0.1', '1.0', '1.0~rc1', '1.0-2', '1.0a'],
+    ...        key=version_key)
+    ['1.0~rc1', '1.0', '1.0-2', '1.0a', '1.9', '1.10', '1:0.1']
+    >>> sorted(['1.0.1', '1.0a', '1.0', '1.0^git1', '1.0~rc1', '1.10'],
+    ...        key=lambda v: version_key(v, 'rpm'))
+    ['1.0~rc1', '1.0', '1.0^git1', '1.0a', '1.0.1', '1.10']
+    >>>
+
+    """
+    if version is None:
+        return None
+    epoch, version, release = _split_version(version)
+    if pkg_type == 'rpm':
+        part_key = _rpm_part_key
+    else:
+        part_key = _deb_part_key
+    return _number_key(epoch) + part_key(version) + part_key(release)
+
+def _where(filters):
+    """Return an SQL condition and parameters matching all of filters
+
+    Values containing wildcards are matched with GLOB.  Everything else
+    must match exactly so that the indexes can be used.
+
+    >>> _where([('name', 'testpkg'), ('version', '1.*')])
+    ('name = ? AND version GLOB ?', ['testpkg', '1.*'])
+    >>>
+
+    """
+    conditions = []
+    for column, value in filters:
+        if value is not None and GLOB_CHARS.search(value):
+            conditions.append(column + ' GLOB ?')
+        else:
+            conditions.append(column + ' = ?')
+    return ' AND '.join(conditions), [value for column, value in filters]
+
+def _guess_type(filepath):
+    "Guess the type of the package at filepath from its name"
+    ext = os.path.splitext(filepath)[1][1:]
+    if ext in INSPECT_CMD_TAB:
+        return ext
+    mimetype = mimetypes.guess_type(filepath)[0]
+    if mimetype == 'application/x-debian-package':
+        return 'deb'
+    elif mimetype == 'application/x-rpm':
+        return 'rpm'
+    return None
+
+def _read_package(filepath, pkg_type):
+    """Read the name, arch and version of a package without external tools
+
+    rpm packages also have a release and, if they have one, an epoch.
+    """
+    if pkg_type == 'deb':
+        fields = ubik.debfile.read_control(filepath)
+        keys = ('Package', 'Architecture', 'Version')
+    else:
+        fields = ubik.rpmfile.read_header(filepath)
+        keys = ('NAME', 'ARCH', 'VERSION', 'RELEASE')
+        if 'EPOCH' in fields:
+            keys += ('EPOCH',)
+    return dict(zip(INSPECT_FIELDS, [str(fields[k]) for k in keys]))
+
 class UbikPackageCache(object):
     """Cache specifically for software packages, such as RPM & DEB
 
@@ -81,18 +260,48 @@ class UbikPackageCache(object):
     []
     >>> u.prune()
 
+    link is how packages are put in the cache, see _link().
+
+    If max_bytes is given, the packages used least recently are evicted
+    whenever adding another would take the cache over that many bytes.  If
+    max_age is given, packages that haven't been used for that many days
+    are evicted as well.  Pinned packages are never evicted.
+
+    >>> u.add('tests/testpkg_1.0_all.deb')
+    >>> u.pin('testpkg_1.0_all.deb')
+    >>> u.max_bytes = 1
+    >>> u.evict()
+    []
+    >>> u.unpin('testpkg_1.0_all.deb')
+    >>> u.evict()
+    [u'testpkg_1.0_all.deb']
+    >>> u.list()
+    []
+
     """
-    def __init__(self, cache_dir):
+    def __init__(self, cache_dir, link='reflink', max_bytes=None,
+                 max_age=None):
         cache_dir = os.path.expanduser(cache_dir)
         self.cache_dir = cache_dir
+        self.link = link
+        self.max_bytes = max_bytes
+        self.max_age = max_age
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
 
-        # TODO: detect previous version index and offer to reindex
-
         dbfile=os.path.join(cache_dir, 'index.db')
+        if not os.path.exists(dbfile) and (
+                os.path.isdir(os.path.join(cache_dir, 'deb')) or
+                os.path.isdir(os.path.join(cache_dir, 'rpm'))):
+            log.warning("Package cache %s has no index.  Run 'rug cache "
+                        "reindex' to rebuild it.", cache_dir)
+
         self.conn = sqlite3.connect(dbfile)
         self.conn.row_factory = sqlite3.Row
+        # Only takes effect for new databases, see _migrate() for old ones
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+        # Readers don't block the writer, and vice versa
+        self.conn.execute('PRAGMA journal_mode=WAL;')
 
         c = self.conn.cursor()
         c.execute('CREATE TABLE IF NOT EXISTS packages ('
@@ -104,6 +313,86 @@ class UbikPackageCache(object):
                     'added TEXT DEFAULT CURRENT_TIMESTAMP,'
                     'UNIQUE(name, version, type, arch)'
                   ');')
+        self._migrate()
+
+    def _migrate(self):
+        "Bring the index up to date with SCHEMA_VERSION"
+        version = self.conn.execute('PRAGMA user_version;').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        log.debug("Upgrading cache index from version %d to %d", version,
+                  SCHEMA_VERSION)
+        columns = [r['name'] for r in
+                   self.conn.execute('PRAGMA table_info(packages);')]
+
+        with self.conn:
+            if version < 1:
+                # Sortable version keys and indexes for get() and prune()
+                if 'version_key' not in columns:
+                    self.conn.execute('ALTER TABLE packages '
+                                      'ADD COLUMN version_key TEXT;')
+                rows = self.conn.execute('SELECT filename,version,type '
+                                         'FROM packages;').fetchall()
+                self.conn.executemany('UPDATE packages SET version_key = ? '
+                                      'WHERE filename = ?;',
+                                      [(version_key(r['version'], r['type']),
+                                        r['filename']) for r in rows])
+                self.conn.execute('CREATE INDEX IF NOT EXISTS packages_added '
+                                  'ON packages (name, type, arch, added);')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS '
+                                  'packages_version ON packages '
+                                  '(name, type, arch, version_key, filename);')
+            if version < 2:
+                # Rows added since the last prune() are marked touched
+                if 'touched' not in columns:
+                    self.conn.execute('ALTER TABLE packages ADD COLUMN '
+                                      'touched INTEGER NOT NULL DEFAULT 1;')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS '
+                                  'packages_touched ON packages (touched);')
+                self.conn.execute('CREATE TABLE IF NOT EXISTS settings ('
+                                    'name TEXT PRIMARY KEY,'
+                                    'value'
+                                  ');')
+            if version < 3:
+                # File sizes, access times and pins for evict()
+                for column in ('size INTEGER NOT NULL DEFAULT 0',
+                               'accessed TEXT',
+                               'pinned INTEGER NOT NULL DEFAULT 0'):
+                    if column.split()[0] not in columns:
+                        self.conn.execute('ALTER TABLE packages '
+                                          'ADD COLUMN ' + column + ';')
+                rows = self.conn.execute('SELECT filename,type '
+                                         'FROM packages;').fetchall()
+                sizes = []
+                for r in rows:
+                    filepath = os.path.join(self.cache_dir, r['type'],
+                                            r['filename'])
+                    if os.path.exists(filepath):
+                        sizes.append((os.path.getsize(filepath),
+                                      r['filename']))
+                self.conn.executemany('UPDATE packages SET size = ? '
+                                      'WHERE filename = ?;', sizes)
+                self.conn.execute('UPDATE packages SET accessed = added '
+                                  'WHERE accessed IS NULL;')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS packages_lru '
+                                  'ON packages (pinned, accessed);')
+            self.conn.execute('PRAGMA user_version = %d;' % SCHEMA_VERSION)
+
+        # Existing databases need a VACUUM before incremental_vacuum works
+        if self.conn.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+            self.conn.execute('VACUUM;')
+
+    def _get_setting(self, name, default=None):
+        r = self.conn.execute('SELECT value FROM settings WHERE name = ?;',
+                              (name,)).fetchone()
+        if r:
+            return r['value']
+        return default
+
+    def _set_setting(self, name, value):
+        self.conn.execute('REPLACE INTO settings (name, value) VALUES (?, ?);',
+                          (name, value))
 
     @staticmethod
     def _inspect(filepath, pkg_type=None):
@@ -111,40 +400,108 @@ class UbikPackageCache(object):
 
         >>> UbikPackageCache._inspect('tests/testpkg_1.0_all.deb')
         {'arch': 'all', 'version': '1.0', 'type': 'deb', 'name': 'testpkg'}
+        >>> sorted(UbikPackageCache._inspect(
+        ...     'tests/testpkg-1.0-2.noarch.rpm').items())
+        ... #doctest: +NORMALIZE_WHITESPACE
+        [('arch', 'noarch'), ('epoch', '1'), ('name', 'testpkg'),
+         ('release', '2'), ('type', 'rpm'), ('version', '1.0')]
 
         """
         if not pkg_type:
-            # Try to guess the package type
-            mimetype = mimetypes.guess_type(filepath)[0]
-            if mimetype == 'application/x-debian-package':
-                pkg_type = 'deb'
-            elif mimetype == 'application/x-rpm':
-                pkg_type = 'rpm'
+            pkg_type = _guess_type(filepath)
         pkg = {'type': pkg_type}
+        if pkg_type not in ('deb', 'rpm'):
+            raise CacheException("Not sure how to inspect pkg type %s" %
+                                 pkg_type)
+
+        try:
+            pkg.update(_read_package(filepath, pkg_type))
+            return pkg
+        except (ubik.debfile.DebFileError, ubik.rpmfile.RpmFileError,
+                tarfile.TarError, KeyError) as e:
+            # e.g. control.tar.xz, which python's tarfile can't read
+            log.debug("Unable to read %s, running %s instead: %s", filepath,
+                      INSPECT_CMD_TAB[pkg_type][0], e)
+        except EnvironmentError as e:
+            raise CacheException("Error reading %s: %s" % (filepath, e))
+
+        command = INSPECT_CMD_TAB[pkg_type] + (filepath,)
+        try:
+            process = subprocess.Popen(command, stderr=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+        except OSError as e:
+            raise CacheException("Error running %s to inspect %s: %s"
+                                 % (command[0], filepath, str(e)))
+        else:
+            output = process.communicate()[0]
+            if process.poll():
+                raise CacheException("%s unsuccessful exit" % command[0])
+        pkg.update(dict(zip(INSPECT_FIELDS, output.split())))
+        if pkg.get('epoch') == '(none)':
+            del pkg['epoch']
+
+        return pkg
+
+    def _ingest(self, filepath, destpath, move=False):
+        """Put the file at filepath into the cache at destpath
 
-        if pkg_type in ('deb', 'rpm'):
-            command = INSPECT_CMD_TAB[pkg_type] + (filepath,)
+        With move, the file is renamed into the cache.  Otherwise it's
+        linked according to self.link.  These only work when the file and
+        the cache share a filesystem, so the file is copied if they fail.
+        destpath is replaced atomically.
+        """
+        if os.path.exists(destpath) and os.path.samefile(filepath, destpath):
+            return
+        if move:
             try:
-                process = subprocess.Popen(command, stderr=subprocess.PIPE,
-                                           stdout=subprocess.PIPE)
+                os.rename(filepath, destpath)
+                return
             except OSError as e:
-                raise CacheException("Error running %s to inspect %s: %s"
-                                     % (command[0], filepath, str(e)))
-            else:
-                output = process.communicate()[0]
-                if process.poll():
-                    raise CacheException("%s unsuccessful exit" % command[0])
-            pkg.update(dict(zip(('name','arch','version'), output.split())))
-        else:
-            raise CacheException("Not sure how to inspect pkg type " + pkg_type)
+                if e.errno != errno.EXDEV:
+                    raise
+
+        tmppath = os.path.join(os.path.dirname(destpath), '.%s.%d' %
+                               (os.path.basename(destpath), os.getpid()))
+        try:
+            self._link(filepath, tmppath)
+            os.rename(tmppath, destpath)
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+        if move:
+            os.unlink(filepath)
 
-        return pkg
+    def _link(self, filepath, destpath):
+        """Hardlink, reflink or, failing those, copy filepath to destpath
 
-    def add(self, filepath, **kwargs):
+        Files are reflinked (copy-on-write) where the filesystem supports
+        it and copied otherwise.  If self.link is 'hardlink', they're
+        hardlinked instead, which is fastest but means that anything
+        rewriting the original in place also modifies the cache.
+        """
+        if self.link == 'hardlink':
+            try:
+                os.link(filepath, destpath)
+                return
+            except OSError as e:
+                log.debug("Unable to hardlink %s: %s", filepath, e)
+
+        with open(filepath, 'rb') as src:
+            with open(destpath, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                except (IOError, OSError) as e:
+                    log.debug("Unable to reflink %s, copying: %s", filepath, e)
+                    shutil.copyfileobj(src, dst, 1024*1024)
+        shutil.copymode(filepath, destpath)
+
+    def add(self, filepath, move=False, **kwargs):
         """Adds a package to the cache, copying the file to cache_dir
 
         It is not an error to add a package that already exists.  That package
-        is simply overwritten.
+        is simply overwritten.  With move, the file is moved rather than
+        copied.  Other packages are evicted first if needed to make room.
 
         """
         filename = os.path.basename(filepath)
@@ -159,47 +516,159 @@ class UbikPackageCache(object):
                 if not pkg[f]:
                     pkg[f] = guess[f]
 
+        pkg['version_key'] = version_key(pkg['version'], pkg['type'])
+        pkg['size'] = os.path.getsize(filepath)
+        pkg['added'] = pkg['accessed'] = pkg['pinned'] = None
+
+        self.evict(pkg['size'], filename)
         log.debug('Adding package %s to cache' % filename)
         with self.conn:
-            self.conn.execute('REPLACE INTO packages '
-                              '(name, version, type, arch, filename) VALUES '
-                              '(:name, :version, :type, :arch, :filename);',
-                              pkg)
+            self.conn.execute(REPLACE_SQL, pkg)
 
+        self._ingest(filepath, self._path(pkg), move)
+
+    def _path(self, pkg):
+        "Return the path of pkg in the cache, creating its directory"
         cache_dir_type = os.path.join(self.cache_dir, pkg['type'])
         if not os.path.exists(cache_dir_type):
             os.mkdir(cache_dir_type)
-        shutil.copy(filepath, cache_dir_type)
+        return os.path.join(cache_dir_type, pkg['filename'])
+
+    def _inspect_all(self, files, processes=None):
+        """Inspect many packages at once using a pool of worker processes
+
+        files is a list of (filepath, pkg_type) and pkg_type may be None.
+        Returns a list of package dicts, as returned by _inspect() with the
+        addition of filepath.  Packages that can't be inspected are skipped.
+        """
+        if len(files) > 1 and processes != 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_inspect_worker, files)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_inspect_worker(f) for f in files]
+
+        pkgs = []
+        for filepath, pkg, error in results:
+            if error:
+                log.warning("Skipping %s: %s", filepath, error)
+                continue
+            pkg['filepath'] = filepath
+            pkg['filename'] = os.path.basename(filepath)
+            pkg['version_key'] = version_key(pkg['version'], pkg['type'])
+            pkg['size'] = os.path.getsize(filepath)
+            pkg['added'] = pkg['accessed'] = pkg['pinned'] = None
+            pkgs.append(pkg)
+        return pkgs
+
+    def import_dir(self, path, move=False, processes=None):
+        """Add every package found under path to the cache
+
+        Packages are inspected in parallel by processes worker processes,
+        which defaults to one per CPU, and are added to the index in batches.
+        Room is made for each batch as add() does.  Returns the number of
+        packages added.
+        """
+        files = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                if _guess_type(filepath):
+                    files.append((filepath, None))
+        log.debug("Found %d packages in %s", len(files), path)
+
+        pkgs = self._inspect_all(files, processes)
+        for i in range(0, len(pkgs), INSERT_BATCH):
+            batch = pkgs[i:i + INSERT_BATCH]
+            self.evict(sum(pkg['size'] for pkg in batch))
+            for pkg in batch:
+                self._ingest(pkg['filepath'], self._path(pkg), move)
+            with self.conn:
+                self.conn.executemany(REPLACE_SQL, batch)
+        return len(pkgs)
+
+    def reindex(self, processes=None):
+        """Rebuild the index from the packages in the cache directory
+
+        Packages are inspected in parallel as with import_dir().  The
+        times each package was added and last used, and whether it's
+        pinned, are kept for packages already in the index.  Otherwise
+        they're taken from the file.  Returns the number of packages indexed.
+        """
+        known = dict((r['filename'], r) for r in
+                     self.conn.execute('SELECT filename,added,accessed,pinned '
+                                       'FROM packages;'))
+        files = []
+        for pkg_type in INSPECT_CMD_TAB:
+            cache_dir_type = os.path.join(self.cache_dir, pkg_type)
+            if not os.path.isdir(cache_dir_type):
+                continue
+            for filename in os.listdir(cache_dir_type):
+                if not filename.startswith('.'):
+                    files.append((os.path.join(cache_dir_type, filename),
+                                  pkg_type))
+
+        pkgs = self._inspect_all(files, processes)
+        for pkg in pkgs:
+            if pkg['filename'] in known:
+                r = known[pkg['filename']]
+                pkg.update(added=r['added'], accessed=r['accessed'],
+                           pinned=r['pinned'])
+            else:
+                pkg['added'] = time.strftime('%Y-%m-%d %H:%M:%S',
+                    time.gmtime(os.path.getmtime(pkg['filepath'])))
+        with self.conn:
+            self.conn.execute('DELETE FROM packages;')
+            self.conn.executemany(REPLACE_SQL, pkgs)
+        return len(pkgs)
 
     def get(self, **kwargs):
-        """Look up a package and return its path"""
+        """Look up a package and return its path
+
+        When name is given exactly, this is the package with the highest
+        version, as ordered by its package manager.  Otherwise it's the
+        package added most recently.  The package is marked used for evict().
+        """
         args = ('name', 'version', 'type', 'arch')
-        # Create a dictionary from kwargs of only the args we want
-        where = dict(zip([a for a in args if a in kwargs],
-                         [kwargs[a] for a in args if a in kwargs]))
-        if len(where) == 0:
+        filters = [(a, kwargs[a]) for a in args if a in kwargs]
+        if len(filters) == 0:
             raise CacheException("Missing filters for get")
 
-        c = self.conn.execute('SELECT type,filename FROM packages WHERE ' +
-                              ' GLOB ? AND '.join(where.keys()) + ' GLOB ?' + 
-                              ' ORDER BY added DESC;', where.values())
+        where, params = _where(filters)
+        name = kwargs.get('name')
+        if name and not GLOB_CHARS.search(name):
+            order = 'version_key DESC, added DESC'
+        else:
+            order = 'added DESC'
+        c = self.conn.execute('SELECT rowid,type,filename FROM packages '
+                              'WHERE ' + where + ' ORDER BY ' + order +
+                              ' LIMIT 1;', params)
         r = c.fetchone()
         if r:
+            with self.conn:
+                self.conn.execute('UPDATE packages SET accessed = '
+                                  'CURRENT_TIMESTAMP WHERE rowid = ?;',
+                                  (r['rowid'],))
             cache_path = str(os.path.join(r['type'], r['filename']))
             return os.path.join(self.cache_dir, cache_path)
         return None
 
     def list(self, filename='*', **kwargs):
-        '''Return a list of dictionaries describing requested cache entries'''
+        '''Return a list of dictionaries describing requested cache entries
+
+        Entries are ordered by name, type, arch and then version.
+        '''
         args = ('name', 'version', 'type', 'arch')
-        where = dict(zip([a for a in args if a in kwargs],
-                         [kwargs[a] for a in args if a in kwargs]))
-        where['filename'] = filename
+        filters = [(a, kwargs[a]) for a in args if a in kwargs]
+        filters.append(('filename', filename))
+        where, params = _where(filters)
 
         c = self.conn.execute('SELECT filename,name,version,type,arch,added '
-                              'FROM packages WHERE ' +
-                              ' GLOB ? AND '.join(where.keys()) + ' GLOB ?;',
-                              where.values())
+                              'FROM packages WHERE ' + where +
+                              ' ORDER BY name,type,arch,version_key;', params)
 
         results = []
         for row in c:
@@ -208,40 +677,155 @@ class UbikPackageCache(object):
         return results
 
     # TODO: Deleting packages needs to be tested
-    def prune(self, keep_per_version=None):
-        "Clean up the cache in various ways"
-
-        # This bit validates that all of the filenames still exist
-        pkgs = self.conn.execute('SELECT filename,type FROM packages;')
-        for pkg in pkgs:
-            if not os.path.exists(os.path.join(self.cache_dir, pkg['type'],
-                                               pkg['filename'])):
+    def prune(self, keep_per_version=None, full=False):
+        """Clean up the cache in various ways
+
+        Index entries of packages that no longer exist are removed, and if
+        keep_per_version is given, only that many of the newest versions of
+        each package are kept.  Unless full is true, only packages added
+        since the last prune are checked, which is enough unless package
+        files have been deleted from the cache by hand.  Finally, packages
+        are evicted according to the cache's size and age limits.
+        """
+        with self.conn:
+            # This bit validates that the filenames still exist
+            if full:
+                on_disk = {}
+                for pkg_type in INSPECT_CMD_TAB:
+                    cache_dir_type = os.path.join(self.cache_dir, pkg_type)
+                    if os.path.isdir(cache_dir_type):
+                        on_disk[pkg_type] = set(os.listdir(cache_dir_type))
+                pkgs = self.conn.execute('SELECT filename,type FROM packages;')
+                missing = [pkg['filename'] for pkg in pkgs
+                           if pkg['filename'] not in
+                              on_disk.get(pkg['type'], ())]
+            else:
+                pkgs = self.conn.execute('SELECT filename,type FROM packages '
+                                         'WHERE touched = 1;')
+                missing = [pkg['filename'] for pkg in pkgs
+                           if not os.path.exists(os.path.join(
+                               self.cache_dir, pkg['type'], pkg['filename']))]
+            for filename in missing:
                 log.debug("Package %s missing from cache.  Removing." %
-                          pkg['filename'])
-                self.remove(pkg['filename'], pkg['type'])
-
-        # This bit removes old package versions
-        if keep_per_version:
-            pkg_groups = self.conn.execute('SELECT DISTINCT name,arch,type '
-                                           'FROM packages;')
-            for pkg_group in pkg_groups:
-                values = dict(pkg_group)
-                values['keep'] = keep_per_version
-                pkgs = self.conn.execute('SELECT filename '
-                                         'FROM packages '
-                                         'WHERE name = :name AND arch = :arch '
-                                               'AND type = :type '
-                                         'ORDER BY added DESC '
-                                         'LIMIT -1 OFFSET :keep;',
-                                         values).fetchall()
-
-                if len(pkgs) > 0:
-                    log.debug("Number of packages for %s greater than %s." %
-                              (values['name'], keep_per_version))
-                    for pkg in pkgs:
-                        self.remove(pkg['filename'])
-
-        self.conn.execute('VACUUM;')
+                          filename)
+            self.conn.executemany('DELETE FROM packages WHERE filename = ?;',
+                                  [(filename,) for filename in missing])
+
+            # This bit removes old package versions from every group with
+            # a package added since the last prune
+            old = []
+            if keep_per_version:
+                keep = int(keep_per_version)
+                groups = ('EXISTS (SELECT 1 FROM packages t '
+                                  'WHERE t.touched = 1 AND t.name = p.name '
+                                        'AND t.type = p.type '
+                                        'AND t.arch = p.arch)')
+                if full or self._get_setting('prune_keep') != keep:
+                    groups = '1'
+                ranked = ('SELECT id, filename, type FROM ('
+                            'SELECT rowid AS id, filename, type, ' +
+                            PRUNE_RANK +
+                            ' AS n FROM packages p WHERE ' + groups +
+                          ') WHERE n > :keep')
+                old = self.conn.execute(ranked, {'keep': keep}).fetchall()
+                self.conn.execute('DELETE FROM packages WHERE rowid IN '
+                                  '(SELECT id FROM (' + ranked + '));',
+                                  {'keep': keep})
+                self._set_setting('prune_keep', keep)
+
+            self.conn.execute('UPDATE packages SET touched = 0 '
+                              'WHERE touched = 1;')
+
+        for pkg in old:
+            log.debug('Removing old package %s from cache' % pkg['filename'])
+            self._unlink(pkg)
+        self.evict()
+
+        # incremental_vacuum only frees pages as its results are read
+        self.conn.execute('PRAGMA incremental_vacuum;').fetchall()
+
+    def evict(self, reserve=0, keep=None):
+        """Remove packages to keep the cache within its size and age limits
+
+        Packages that haven't been used in max_age days are removed.  Then
+        the least recently used packages are removed until the cache, plus
+        reserve more bytes, fits in max_bytes.  Pinned packages and the
+        package named keep are never removed.  Returns the filenames of the
+        removed packages.
+        """
+        if not (self.max_bytes or self.max_age):
+            return []
+        lru = ('SELECT rowid AS id, filename, type, size FROM packages '
+               'WHERE pinned = 0 AND filename IS NOT :keep')
+        params = {'keep': keep, 'age': '-%d days' % (self.max_age or 0)}
+
+        with self.conn:
+            evicted = []
+            if self.max_age:
+                evicted = self.conn.execute(lru + ' AND accessed < '
+                                            'datetime(\'now\', :age);',
+                                            params).fetchall()
+            if self.max_bytes:
+                total = self.conn.execute('SELECT COALESCE(SUM(size), 0) '
+                                          'FROM packages WHERE filename '
+                                          'IS NOT :keep;', params).fetchone()
+                excess = (total[0] + reserve - self.max_bytes -
+                          sum(pkg['size'] for pkg in evicted))
+                if excess > 0:
+                    seen = set(pkg['id'] for pkg in evicted)
+                    c = self.conn.execute(lru + ' ORDER BY accessed, rowid;',
+                                          params)
+                    for pkg in c:
+                        if excess <= 0:
+                            break
+                        if pkg['id'] not in seen:
+                            evicted.append(pkg)
+                            excess -= pkg['size']
+                    c.close()
+                if excess > 0:
+                    log.warning("Package cache %s will be %d bytes over its "
+                                "limit since nothing else can be evicted",
+                                self.cache_dir, excess)
+            self.conn.executemany('DELETE FROM packages WHERE rowid = ?;',
+                                  [(pkg['id'],) for pkg in evicted])
+
+        for pkg in evicted:
+            log.debug('Evicting package %s from cache' % pkg['filename'])
+            self._unlink(pkg)
+        return [pkg['filename'] for pkg in evicted]
+
+    def pin(self, filename, exclusive=False):
+        """Keep the package filename in the cache until it's unpinned
+
+        pin() and unpin() only protect packages from evict(), not from
+        prune() or remove().  With exclusive, other versions of the same
+        package are unpinned.
+        """
+        with self.conn:
+            r = self.conn.execute('SELECT name,type,arch FROM packages '
+                                  'WHERE filename = ?;',
+                                  (filename,)).fetchone()
+            if not r:
+                raise CacheException('Filename %s not in the cache' % filename)
+            if exclusive:
+                self.conn.execute('UPDATE packages SET pinned = 0 '
+                                  'WHERE name = ? AND type = ? AND arch = ? '
+                                        'AND pinned = 1;',
+                                  (r['name'], r['type'], r['arch']))
+            self.conn.execute('UPDATE packages SET pinned = 1 '
+                              'WHERE filename = ?;', (filename,))
+
+    def unpin(self, filename):
+        "Allow the package filename to be evicted again"
+        with self.conn:
+            self.conn.execute('UPDATE packages SET pinned = 0 '
+                              'WHERE filename = ?;', (filename,))
+
+    def _unlink(self, pkg):
+        "Delete the file of pkg, a row of the index, if it exists"
+        filepath = os.path.join(self.cache_dir, pkg['type'], pkg['filename'])
+        if os.path.exists(filepath):
+            os.unlink(filepath)
 
     def remove(self, filename, pkg_type=None):
         '''Remove a particular filename from the cache'''
@@ -261,8 +845,89 @@ class UbikPackageCache(object):
         if os.path.exists(filepath):
             os.unlink(filepath)
 
+def _inspect_worker(args):
+    "Inspect a package for UbikPackageCache._inspect_all()"
+    filepath, pkg_type = args
+    try:
+        return filepath, UbikPackageCache._inspect(filepath, pkg_type), None
+    except Exception as e:
+        return filepath, None, str(e)
+
+class UbikBuildCache(object):
+    """Cache of build root trees, keyed by a digest of the build's inputs
+
+    Each key is a directory in cache_dir holding the tree as 'root'.  link
+    is as for UbikPackageCache.
+
+    >>> b=UbikBuildCache('tests/out/buildcache')
+    >>> b.restore('0123abcd', 'tests/out/restored')
+    False
+    >>> b.store('0123abcd', 'tests/root')
+    >>> b.restore('0123abcd', 'tests/out/restored')
+    True
+    >>> sorted(os.listdir('tests/out/restored/opt'))
+    ['dirA', 'dirB']
+    >>> b.remove('0123abcd')
+    >>> b.restore('0123abcd', 'tests/out/restored')
+    False
+
+    """
+    def __init__(self, cache_dir, link='reflink'):
+        cache_dir = os.path.expanduser(cache_dir)
+        self.cache_dir = cache_dir
+        self.link = link
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _copytree(self, src, dst):
+        "Copy the tree src to dst the way UbikPackageCache._link() copies"
+        if self.link == 'hardlink':
+            command = ('cp', '-al', src, dst)
+        else:
+            command = ('cp', '-a', '--reflink=auto', src, dst)
+        log.debug('Copying tree: ' + ' '.join(command))
+        subprocess.check_call(command)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, rootdir):
+        """Replace rootdir with the cached tree for key
+
+        Returns True if the tree was restored, False if key isn't cached.
+        """
+        cached = os.path.join(self.path(key), 'root')
+        if not os.path.exists(cached):
+            return False
+        log.debug('Restoring build %s to %s' % (key, rootdir))
+        if os.path.exists(rootdir):
+            shutil.rmtree(rootdir)
+        self._copytree(cached, rootdir)
+        # Touch the entry so that it's possible to find stale builds
+        os.utime(self.path(key), None)
+        return True
+
+    def store(self, key, rootdir):
+        "Add the tree at rootdir to the cache as key, replacing any old one"
+        log.debug('Storing build %s from %s' % (key, rootdir))
+        tmpdir = tempfile.mkdtemp(prefix='.' + key, dir=self.cache_dir)
+        try:
+            self._copytree(rootdir, os.path.join(tmpdir, 'root'))
+            self.remove(key)
+            os.rename(tmpdir, self.path(key))
+        except:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+    def remove(self, key):
+        "Remove key from the cache, if it exists"
+        if os.path.exists(self.path(key)):
+            shutil.rmtree(self.path(key))
+
 if __name__ == '__main__':
     import doctest
-    if os.path.exists('tests/out/cache'):
-        shutil.rmtree('tests/out/cache')
+    for outdir in ('tests/out/cache', 'tests/out/buildcache',
+                   'tests/out/restored'):
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
     doctest.testmod(optionflags=doctest.ELLIPSIS, verbose=False)
@@ -0,0 +1,214 @@
+# Copyright 2012 Lee Verberne <lee@blarg.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"Pure python reading and writing of debian package archives"
+
+import grp
+import logging
+import os, os.path
+import pwd
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import time
+
+log = logging.getLogger('ubik.debfile')
+
+AR_MAGIC = '!<arch>\n'
+DEB_BINARY_VERSION = '2.0\n'
+CONTROL_SCRIPTS = ('preinst', 'postinst', 'prerm', 'postrm', 'config')
+COPY_BUFSIZE = 1024*1024
+
+class DebFileError(Exception):
+    pass
+
+def _ar_header(name, size, mtime, mode=0100644):
+    """Return a common ar format member header
+
+    >>> _ar_header('debian-binary', 4, 0)
+    'debian-binary   0           0     0     100644  4         `\\n'
+    >>>
+
+    """
+    if len(name) > 16:
+        raise DebFileError("ar member name too long: " + name)
+    return '%-16s%-12d%-6d%-6d%-8o%-10d`\n' % (name, mtime, 0, 0, mode, size)
+
+def _ar_add(ar, name, fileobj, size, mtime):
+    "Append fileobj to the open ar archive as member name"
+    ar.write(_ar_header(name, size, mtime))
+    shutil.copyfileobj(fileobj, ar, COPY_BUFSIZE)
+    if size % 2:
+        ar.write('\n')
+
+def _uid(user):
+    try:
+        return pwd.getpwnam(user).pw_uid
+    except KeyError:
+        return 0
+
+def _gid(group):
+    try:
+        return grp.getgrnam(group).gr_gid
+    except KeyError:
+        return 0
+
+def _tar_add(tar, path, arcname, owner='root', group='root', mode=None):
+    """Add path to tar as arcname with the given ownership and mode
+
+    Ownership is recorded by name (which is what dpkg honors at install time)
+    and by the uid/gid of that name on this host, if it exists.
+    """
+    info = tar.gettarinfo(path, arcname)
+    info.uname = owner
+    info.gname = group
+    info.uid = _uid(owner)
+    info.gid = _gid(group)
+    if mode is not None:
+        info.mode = mode
+    if info.isreg():
+        with open(path, 'rb') as f:
+            tar.addfile(info, f)
+    else:
+        tar.addfile(info)
+
+def write_deb(debpath, controldir, rootdir, entries):
+    """Write a binary debian package without dpkg-deb or fakeroot
+
+    controldir is a directory containing the DEBIAN control files (control,
+    md5sums, maintainer scripts, etc).  rootdir is the package root and
+    entries is a list of (relpath, owner, group, mode) tuples describing
+    every path of the data archive, parents first.  A mode of None uses the
+    mode of the file on disk.
+
+    The data archive is streamed through a temporary file since the ar
+    container needs to know member sizes in advance.
+
+    >>> import os, tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(d, 'DEBIAN'))
+    >>> with open(os.path.join(d, 'DEBIAN', 'control'), 'w') as f:
+    ...     f.write('Package: test\\n')
+    >>> write_deb(os.path.join(d, 'test.deb'), os.path.join(d, 'DEBIAN'),
+    ...           'tests/root', [('', 'root', 'root', None),
+    ...                          ('opt', 'root', 'root', None),
+    ...                          ('opt/dirA', 'root', 'root', None),
+    ...                          ('opt/dirA/fileA-1', 'nobody', 'root', 0755)])
+    >>> sorted(read_control(os.path.join(d, 'test.deb')).items())
+    [('Package', 'test')]
+    >>>
+
+    """
+    mtime = int(time.time())
+    with open(debpath, 'wb') as ar:
+        ar.write(AR_MAGIC)
+        _ar_add(ar, 'debian-binary', StringIO.StringIO(DEB_BINARY_VERSION),
+                len(DEB_BINARY_VERSION), mtime)
+
+        control = StringIO.StringIO()
+        tar = tarfile.open(fileobj=control, mode='w:gz',
+                           format=tarfile.GNU_FORMAT)
+        try:
+            _tar_add(tar, controldir, '.', mode=0755)
+            for filename in sorted(os.listdir(controldir)):
+                mode = 0644
+                if filename in CONTROL_SCRIPTS:
+                    mode = 0755
+                _tar_add(tar, os.path.join(controldir, filename),
+                         './' + filename, mode=mode)
+        finally:
+            tar.close()
+        size = control.tell()
+        control.seek(0)
+        _ar_add(ar, 'control.tar.gz', control, size, mtime)
+
+        data = tempfile.TemporaryFile(prefix='debfile-')
+        try:
+            tar = tarfile.open(fileobj=data, mode='w:gz',
+                               format=tarfile.GNU_FORMAT)
+            try:
+                for relpath, owner, group, mode in entries:
+                    relpath = relpath.strip('/')
+                    arcname = './' + relpath if relpath else '.'
+                    _tar_add(tar, os.path.join(rootdir, relpath), arcname,
+                             owner, group, mode)
+            finally:
+                tar.close()
+            size = data.tell()
+            data.seek(0)
+            _ar_add(ar, 'data.tar.gz', data, size, mtime)
+        finally:
+            data.close()
+    log.debug("Wrote %s with %d data entries", debpath, len(entries))
+
+def _ar_members(fileobj):
+    "Generate (name, size) for each member of an ar archive, seeking to data"
+    if fileobj.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebFileError("Not an ar archive")
+    while True:
+        header = fileobj.read(60)
+        if len(header) < 60:
+            return
+        name = header[:16].rstrip().rstrip('/')
+        size = int(header[48:58])
+        start = fileobj.tell()
+        yield name, size
+        fileobj.seek(start + size + size % 2)
+
+def read_control(debpath):
+    """Return the control fields of a debian package as a dictionary
+
+    Continuation lines (such as the long Description) are folded into the
+    field they continue.
+
+    >>> c = read_control('tests/testpkg_1.0_all.deb')
+    >>> (c['Package'], c['Version'], c['Architecture'])
+    ('testpkg', '1.0', 'all')
+    >>>
+
+    """
+    with open(debpath, 'rb') as deb:
+        for name, size in _ar_members(deb):
+            if name.startswith('control.tar'):
+                member = StringIO.StringIO(deb.read(size))
+                break
+        else:
+            raise DebFileError("No control archive in " + debpath)
+
+    tar = tarfile.open(fileobj=member, mode='r:*')
+    try:
+        for info in tar:
+            if info.name in ('./control', 'control'):
+                text = tar.extractfile(info).read()
+                break
+        else:
+            raise DebFileError("No control file in " + debpath)
+    finally:
+        tar.close()
+
+    fields = {}
+    field = None
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and field:
+            fields[field] += '\n' + line
+        elif ':' in line:
+            field, value = line.split(':', 1)
+            fields[field] = value.strip()
+    return fields
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS, verbose=False)
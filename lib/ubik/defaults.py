@@ -22,11 +22,32 @@ CONFIG_FILE = '~/.rug/rug.ini'
 GLOBAL_CONFIG_FILE = '/etc/ubik.ini'
 
 config_defaults = {
+    "builder.cache": "false",
+    "builder.cache_dir": "~/.rug/builds",
     "builder.iniuri": "https://deploy/ini",
     "cache.dir":    "~/.rug/cache",
+    "cache.git_mirrors": "true",
+    "cache.git_mirrors_max": "32",
+    "cache.git_mirrors_max_mb": "4096",
+    "cache.link": "reflink",
+    "cache.max_age_days": "0",
+    "cache.max_mb": "0",
+    "cache.tgz_max_mb": "2048",
+    "deploy.batch": "",
+    "deploy.batch_by_dc": "false",
+    "deploy.delta": "false",
+    "deploy.distribution": "direct",
+    "deploy.health_timeout": "120",
+    "deploy.on_error": "abort",
+    "deploy.parallel": "10",
     "deploy.user": "prod",
     "deploy.restart": "false",
+    "deploy.skip_installed": "true",
+    "infradb.cache_file": "~/.rug/dnscache.json",
+    "infradb.concurrency": "16",
     "infradb.driver": "dns",
+    "infradb.snapshot": "~/.rug/infradb.snapshot",
+    "infradb.zone": "",
     "package.license": "Proprietary",
     "package.maintainer": "%(login)s@%(node)s",
     "package:deb.lintian_suppress": (
@@ -1,7 +1,10 @@
 
+import ConfigParser
 import shlex
 import subprocess
 
+import ubik.defaults
+
 # Fabric 1.0 changed changed the scope of cd() to only affect remote calls.
 # With fabric >1.0 cd() was replaced with lcd() for local calls.  This helper
 # function will execute commands independent of fabric and maintain <1.0 compat
@@ -9,3 +12,28 @@ def _local(command_string, cwd=None):
     print "[localhost] run:", command_string
     subprocess.check_call(shlex.split(command_string), cwd=cwd)
 
+
+def _get_sparse_paths(config, section, config_vars=None):
+    """Return the source paths that a sparse checkout should include
+
+    The 'sparse' option of section may be a boolean or a whitespace separated
+    list of paths.  When true, the paths are the subdirs of the configured
+    build modules.  An empty list means a full checkout.
+    """
+    from ubik import builder
+
+    if not config.has_option(section, 'sparse'):
+        return []
+    sparse = config.get(section, 'sparse', vars=config_vars).strip()
+    if sparse.lower() in ('', 'false', 'no', '0'):
+        return []
+    if sparse.lower() in ('true', 'yes', '1'):
+        return builder.build_subdirs(config, config_vars)
+    return sparse.split()
+
+def _get_cache_option(config, option):
+    "Get a [cache] option, falling back to ubik.defaults for plain configs"
+    try:
+        return config.get('cache', option)
+    except ConfigParser.Error:
+        return ubik.defaults.config_defaults['cache.' + option]
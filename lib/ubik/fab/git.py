@@ -14,10 +14,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ConfigParser
+import errno
+import fcntl
+import hashlib
 import logging
 import os, os.path
+import subprocess
+import time
 
-from . import _local
+from . import _local, _get_cache_option, _get_sparse_paths
 from ubik import builder
 
 NAME = 'git'
@@ -28,6 +33,119 @@ def _get_config(configfile='package.ini'):
     config.read(configfile)
     return config
 
+def _dir_size(path):
+    "Return the total size in bytes of files under path"
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def _mirror_size(mirror):
+    "Return the size of mirror as recorded by _update_mirror()"
+    try:
+        with open(mirror + '.size') as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return _dir_size(mirror)
+
+def _evict_mirrors(pooldir, keep, max_count, max_bytes):
+    """Remove least recently used mirrors beyond max_count or max_bytes
+
+    Mirror directory mtimes record when they were last used.  The mirror
+    named keep, which is in use, is never removed, and neither are mirrors
+    locked by other builds.  Lock files are left in place since another
+    build may already have one open.
+    """
+    mirrors = []
+    for name in os.listdir(pooldir):
+        path = os.path.join(pooldir, name)
+        if name.endswith('.git') and os.path.isdir(path):
+            mirrors.append((os.path.getmtime(path), path))
+    mirrors.sort(reverse=True)
+
+    total = 0
+    for count, (mtime, path) in enumerate(mirrors):
+        size = _mirror_size(path)
+        total += size
+        if path == keep or (count < max_count and total <= max_bytes):
+            continue
+        with open(path + '.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                log.debug("Not evicting git mirror %s, which is in use", path)
+                continue
+            log.info("Evicting git mirror %s (%d bytes, last used %s)", path,
+                     size, time.ctime(mtime))
+            subprocess.call(('rm', '-rf', path, path + '.size'))
+        total -= size
+
+def _update_mirror(repo, mirror):
+    """Create or incrementally fetch the bare mirror of repo
+
+    The caller must hold the mirror's lock.  The mirror's size is recorded
+    for _evict_mirrors() so that it doesn't need to walk every mirror.
+    """
+    if os.path.exists(mirror):
+        log.debug("Fetching into git mirror %s", mirror)
+        _local("git --git-dir=%s remote update --prune" % mirror)
+    else:
+        log.info("Creating git mirror of %s in %s", repo, mirror)
+        try:
+            _local("git clone --mirror %s %s" % (repo, mirror))
+        except:
+            subprocess.call(('rm', '-rf', mirror))
+            raise
+    os.utime(mirror, None)
+    with open(mirror + '.size', 'w') as f:
+        f.write(str(_dir_size(mirror)))
+
+def _clone_from_mirror(repo, srcdir, config, options=''):
+    """Clone repo to srcdir using the local mirror pool
+
+    options are passed through to git clone.  Returns False if the mirror
+    couldn't be used, in which case the caller should fall back to a
+    regular clone.
+    """
+    cache_dir = os.path.expanduser(_get_cache_option(config, 'dir'))
+    pooldir = os.path.join(cache_dir, 'git')
+    mirror = os.path.join(pooldir, hashlib.sha1(repo).hexdigest() + '.git')
+    try:
+        if not os.path.exists(pooldir):
+            try:
+                os.makedirs(pooldir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # The lock keeps other builds from fetching into, gc'ing or evicting
+        # the mirror while it's in use.  --dissociate copies the objects
+        # borrowed from the mirror once the clone is done, so the clone
+        # doesn't depend on the mirror afterward.
+        with open(mirror + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _update_mirror(repo, mirror)
+            _local("git clone --reference %s --dissociate %s %s %s" %
+                   (mirror, options, repo, srcdir))
+    except (IOError, OSError, subprocess.CalledProcessError) as e:
+        log.warning("Unable to clone %s from mirror: %s", repo, e)
+        subprocess.call(('rm', '-rf', os.path.join(srcdir, '.git')))
+        return False
+
+    try:
+        _evict_mirrors(pooldir, mirror,
+                       int(_get_cache_option(config, 'git_mirrors_max')),
+                       int(_get_cache_option(config, 'git_mirrors_max_mb'))
+                       * 1024 * 1024)
+    except (IOError, OSError) as e:
+        log.warning("Unable to evict git mirrors: %s", e)
+    return True
+
 def clone(version, config, env):
     'Clones a git repo and potentially chooses a tag'
     if not version:
@@ -44,17 +162,70 @@ def clone(version, config, env):
         'version': version.split('-',1)[0],
     }
     repo = config.get(NAME, 'repo', vars=config_vars)
+    ref = None
+    if config.has_option(NAME, 'tag'):
+        ref = config.get(NAME, 'tag', vars=config_vars)
+    elif config.has_option(NAME, 'branch'):
+        ref = config.get(NAME, 'branch', vars=config_vars)
+    shallow = (config.has_option(NAME, 'shallow') and
+               config.getboolean(NAME, 'shallow'))
+    sparse_paths = _get_sparse_paths(config, NAME, config_vars)
 
     # Clone if doesn't exist, but don't touch repo otherwise
     if not os.path.exists(os.path.join(env.srcdir, '.git')):
-        _local("git clone %s %s" % (repo, env.srcdir))
+        options = ''
+        if sparse_paths:
+            options = '--no-checkout'
+        if shallow:
+            # A shallow clone only transfers the commit being built, which
+            # makes the mirror pool moot
+            if ref:
+                options += ' --branch %s' % ref
+            _local("git clone --depth 1 %s %s %s" % (options, repo,
+                                                     env.srcdir))
+        else:
+            use_mirror = _get_cache_option(config, 'git_mirrors')
+            if not (use_mirror.lower() in ('true', 'yes', '1') and
+                    _clone_from_mirror(repo, env.srcdir, config, options)):
+                _local("git clone %s %s %s" % (options, repo, env.srcdir))
+
+        if sparse_paths:
+            log.info("Sparse checkout of %s", ', '.join(sparse_paths))
+            _local("git config core.sparseCheckout true", cwd=env.srcdir)
+            with open(os.path.join(env.srcdir, '.git', 'info',
+                                   'sparse-checkout'), 'w') as f:
+                for path in sparse_paths:
+                    print >>f, '/' + path.strip('/') + '/'
+            _local("git read-tree -mu HEAD", cwd=env.srcdir)
+
+    if ref:
+        _local("git checkout %s" % ref, cwd=env.srcdir)
 
+def revision(version, config, env):
+    """Resolve the commit that clone() would check out, without cloning
+
+    Returns None if the commit can't be determined.
+    """
+    if not version:
+        version = ''
+    config_vars = {
+        'root': os.path.abspath(env.rootdir),
+        'version': version.split('-',1)[0],
+    }
+    repo = config.get(NAME, 'repo', vars=config_vars)
+    ref = 'HEAD'
     if config.has_option(NAME, 'tag'):
-        _local("git checkout %s" % config.get(NAME, 'tag', vars=config_vars),
-               cwd=env.srcdir)
+        ref = config.get(NAME, 'tag', vars=config_vars)
     elif config.has_option(NAME, 'branch'):
-        _local("git checkout %s" % config.get(NAME, 'branch', vars=config_vars),
-               cwd=env.srcdir)
+        ref = config.get(NAME, 'branch', vars=config_vars)
+
+    process = subprocess.Popen(('git', 'ls-remote', repo, ref),
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode or not output.strip():
+        log.info("Could not resolve %s in %s", ref, repo)
+        return None
+    return output.split()[0]
 
 if __name__ == '__main__':
     clone("0.9.13", "doc/example-%s.ini" % NAME,
@@ -130,10 +130,12 @@ def package(version=None, config=None, pkgtype='deb', env=None):
     elif not env.exists('rootdir'):
         build(version, config, env)
 
+    index = None
     for pkgtype in 'deb','rpm':
         if config.has_section(pkgtype):
-            pkg = packager.Package(config, env, pkgtype)
+            pkg = packager.Package(config, env, pkgtype, index=index)
             pkg.build(version)
+            index = pkg.index
 
     if cleanitup:
         local('rm -rf %s' % env.rootdir)
@@ -16,8 +16,9 @@
 import ConfigParser
 import logging
 import os, os.path
+import subprocess
 
-from . import _local
+from . import _local, _get_sparse_paths
 
 NAME = 'svn'
 log = logging.getLogger(NAME)
@@ -27,6 +28,31 @@ def _get_config(configfile='package.ini'):
     config.read(configfile)
     return config
 
+def _config_vars(version, env):
+    """Return the variables that can be percent expanded in the ini
+
+    These are the same as the git module's, so that sparse checkouts can
+    use the subdirs of build modules that refer to %(root)s.
+
+    >>> from ubik import builder
+    >>> config = ConfigParser.SafeConfigParser()
+    >>> config.add_section('svn')
+    >>> config.set('svn', 'sparse', 'true')
+    >>> config.add_section('make')
+    >>> config.set('make', 'subdir', 'src/c')
+    >>> config.add_section('maven')
+    >>> config.set('maven', 'subdir', '%(root)s/_src')
+    >>> env = builder.BuildEnv(rootdir='tests/root')
+    >>> _get_sparse_paths(config, NAME, _config_vars('1.0-1', env))
+    ['src/c']
+    >>>
+
+    """
+    return {
+        'root': os.path.abspath(env.rootdir),
+        'version': version.split('-',1)[0],
+    }
+
 def checkout(version, config, env):
     'Checks out a particular svn respository'
     if not version:
@@ -34,12 +60,51 @@ def checkout(version, config, env):
     if not config:
         config = _get_config()
 
-    repo = config.get(NAME, 'repo', False, 
-                      {'version': version.split('-',1)[0],})
+    config_vars = _config_vars(version, env)
+    repo = config.get(NAME, 'repo', False, config_vars)
+    sparse_paths = _get_sparse_paths(config, NAME, config_vars)
 
-    if not os.path.exists(os.path.join(env.srcdir, '.svn')):
-        _local("svn co %s %s" % (repo, env.srcdir))
+    if config.has_option(NAME, 'shallow') and config.getboolean(NAME,
+                                                                'shallow'):
+        # svn checkouts have no history, but an export also skips the
+        # pristine copy of every file and the working copy metadata
+        if not sparse_paths:
+            _local("svn export --force %s %s" % (repo, env.srcdir))
+        for path in sparse_paths:
+            path = path.strip('/')
+            dest = os.path.join(env.srcdir, path)
+            if not os.path.exists(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            _local("svn export --force %s/%s %s" % (repo.rstrip('/'), path,
+                                                   dest))
+    elif not os.path.exists(os.path.join(env.srcdir, '.svn')):
+        if sparse_paths:
+            log.info("Sparse checkout of %s", ', '.join(sparse_paths))
+            _local("svn co --depth empty %s %s" % (repo, env.srcdir))
+            for path in sparse_paths:
+                _local("svn update --parents --set-depth infinity %s" %
+                       path.strip('/'), cwd=env.srcdir)
+        else:
+            _local("svn co %s %s" % (repo, env.srcdir))
     else:
-        with cd(env.srcdir):
-            _local("svn update")
+        _local("svn update", cwd=env.srcdir)
+
+def revision(version, config, env):
+    """Resolve the last changed revision of the repo that checkout() uses
+
+    Returns None if the revision can't be determined.
+    """
+    if not version:
+        version = ''
+    repo = config.get(NAME, 'repo', False, _config_vars(version, env))
 
+    process = subprocess.Popen(('svn', 'info', '--non-interactive', repo),
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        log.info("Could not get svn info for %s", repo)
+        return None
+    for line in output.splitlines():
+        if line.startswith('Last Changed Rev:'):
+            return '%s@%s' % (repo, line.split(':', 1)[1].strip())
+    return None
@@ -14,19 +14,236 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ConfigParser
+import errno
+import fcntl
+import hashlib
+import json
 import logging
 import os, os.path
+import tarfile
+import tempfile
+import urllib2
 
-from fabric.api import local, prompt
+from . import _get_cache_option
 
 NAME = 'tgz'
 log = logging.getLogger(NAME)
 
+DOWNLOAD_BUFSIZE = 1024*1024
+
+class TgzException(Exception):
+    pass
+
 def _get_config(configfile='package.ini'):
     config = ConfigParser.SafeConfigParser()
     config.read(configfile)
     return config
 
+def _read_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _write_meta(path, meta):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.rename(path + '.tmp', path)
+
+def _download(response, pooldir):
+    """Stream response to a temporary file in pooldir
+
+    Returns the sha256 hexdigest of the content and the temporary file name.
+    """
+    sha256 = hashlib.sha256()
+    fd, tmpname = tempfile.mkstemp(prefix='download-', dir=pooldir)
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                buf = response.read(DOWNLOAD_BUFSIZE)
+                if not buf:
+                    break
+                sha256.update(buf)
+                tmp.write(buf)
+    except:
+        os.unlink(tmpname)
+        raise
+    return sha256.hexdigest(), tmpname
+
+def _evict(pooldir, keep, max_bytes):
+    """Remove least recently used archives until the pool fits in max_bytes
+
+    Archive mtimes record when they were last used.  The archive named keep,
+    which is in use, is never removed.
+    """
+    archives = []
+    for name in os.listdir(pooldir):
+        path = os.path.join(pooldir, name)
+        if len(name) == 64 and os.path.isfile(path):
+            st = os.stat(path)
+            archives.append((st.st_mtime, st.st_size, path))
+    archives.sort(reverse=True)
+
+    total = 0
+    for mtime, size, path in archives:
+        total += size
+        if path == keep or total <= max_bytes:
+            continue
+        log.info("Evicting cached source archive %s (%d bytes)", path, size)
+        os.unlink(path)
+        total -= size
+
+def fetch(sourceurl, pooldir, sha256=None):
+    """Return the path of a cached copy of sourceurl, downloading if needed
+
+    Archives are stored under the sha256 of their content.  When sha256 is
+    given the cached archive is used without contacting the server and
+    downloads that don't match it are rejected.  Otherwise the cached copy
+    is revalidated with the server using its ETag and Last-Modified headers.
+    """
+    if not os.path.exists(pooldir):
+        try:
+            os.makedirs(pooldir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    if sha256:
+        sha256 = sha256.lower()
+        archive = os.path.join(pooldir, sha256)
+        if os.path.exists(archive):
+            log.info("Using cached %s for %s", archive, sourceurl)
+            os.utime(archive, None)
+            return archive
+
+    metapath = os.path.join(pooldir, hashlib.sha1(sourceurl).hexdigest())
+    with open(metapath + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        meta = _read_meta(metapath + '.json')
+        cached = None
+        if meta.get('sha256') and meta['sha256'] == (sha256 or meta['sha256']):
+            cached = os.path.join(pooldir, meta['sha256'])
+            if not os.path.exists(cached):
+                cached = None
+
+        request = urllib2.Request(sourceurl)
+        if cached and meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if cached and meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached:
+                log.info("%s not modified, using cached %s", sourceurl, cached)
+                os.utime(cached, None)
+                return cached
+            raise TgzException("Unable to download %s: %s" % (sourceurl, e))
+        except urllib2.URLError as e:
+            if cached:
+                log.warning("Unable to revalidate %s, using cached %s: %s",
+                            sourceurl, cached, e)
+                os.utime(cached, None)
+                return cached
+            raise TgzException("Unable to download %s: %s" % (sourceurl, e))
+
+        log.info("Downloading %s", sourceurl)
+        try:
+            digest, tmpname = _download(response, pooldir)
+        finally:
+            response.close()
+        if sha256 and digest != sha256:
+            os.unlink(tmpname)
+            raise TgzException("sha256 of %s is %s, expected %s" %
+                               (sourceurl, digest, sha256))
+        archive = os.path.join(pooldir, digest)
+        os.rename(tmpname, archive)
+        headers = response.info()
+        _write_meta(metapath + '.json', {
+            'url': sourceurl,
+            'sha256': digest,
+            'etag': headers.getheader('ETag'),
+            'last_modified': headers.getheader('Last-Modified'),
+        })
+    return archive
+
+def _within(path, destdir):
+    "Return True if path is destdir or under it"
+    return path == destdir or path.startswith(destdir + os.sep)
+
+def extract(archive, destdir):
+    """Extract a tar archive to destdir, streaming it in a single pass
+
+    Members are skipped if they would be extracted outside of destdir,
+    including through a symlink created by the archive, and so are links
+    to anything outside of destdir.
+
+    >>> import StringIO
+    >>> def member(name, type=tarfile.REGTYPE, linkname=''):
+    ...     info = tarfile.TarInfo(name)
+    ...     info.type, info.linkname = type, linkname
+    ...     return info
+    >>> if not os.path.exists('tests/out'):
+    ...     os.makedirs('tests/out')
+    >>> tar = tarfile.open('tests/out/links.tar', 'w')
+    >>> for info in (member('sub/ok'),
+    ...              member('etc', tarfile.SYMTYPE, '/etc'),
+    ...              member('etc/passwd'),
+    ...              member('up', tarfile.SYMTYPE, 'sub/../..'),
+    ...              member('dir', tarfile.SYMTYPE, 'sub'),
+    ...              member('dir/file'),
+    ...              member('link', tarfile.SYMTYPE, 'ok'),
+    ...              member('shadow', tarfile.LNKTYPE, '../shadow'),
+    ...              member('hard', tarfile.LNKTYPE, 'sub/ok')):
+    ...     tar.addfile(info, StringIO.StringIO(''))
+    >>> tar.close()
+    >>> extract('tests/out/links.tar', 'tests/out/links')
+    >>> sorted(os.listdir('tests/out/links'))
+    ['dir', 'etc', 'hard', 'link', 'sub']
+    >>> os.path.islink('tests/out/links/etc')
+    False
+    >>> os.listdir('tests/out/links/sub')
+    ['ok']
+    >>>
+
+    """
+    destdir = os.path.realpath(destdir)
+    # Symlinks created by this archive, by member name
+    links = set()
+    tar = tarfile.open(archive, mode='r|*')
+    try:
+        for info in tar:
+            name = os.path.normpath(info.name)
+            parts = name.split(os.sep)
+            safe = not (os.path.isabs(name) or parts[0] == '..')
+            if safe:
+                paths = [os.sep.join(parts[:i + 1]) for i in range(len(parts))]
+                parent = os.path.realpath(os.path.join(destdir,
+                                                       os.path.dirname(name)))
+                safe = (_within(parent, destdir) and
+                        not links.intersection(paths))
+            if safe and info.issym():
+                safe = _within(os.path.realpath(os.path.join(
+                                    parent, info.linkname)), destdir)
+            elif safe and info.islnk():
+                safe = _within(os.path.realpath(os.path.join(
+                                    destdir, info.linkname)), destdir)
+            if not safe:
+                log.warning("Skipping unsafe member %s of %s", info.name,
+                            archive)
+                continue
+            if info.issym():
+                links.add(name)
+            tar.extract(info, destdir)
+    finally:
+        tar.close()
+
+def _get_sha256(config, config_vars):
+    try:
+        return config.get(NAME, 'sha256', False, config_vars).strip() or None
+    except ConfigParser.NoOptionError:
+        return None
+
 def untar(version, config, env):
     'Downloads a file URI and untars to builddir'
     if not version:
@@ -42,13 +259,38 @@ def untar(version, config, env):
     except ConfigParser.NoOptionError:
         pass
 
-    sourceurl = config.get(NAME, 'source', False, 
-                      {'version': version.split('-',1)[0],})
+    config_vars = {'version': version.split('-',1)[0],}
+    sourceurl = config.get(NAME, 'source', False, config_vars)
     log.debug('Using source URL of %s' % sourceurl)
 
-    # For now just use system tools for this
-    if not os.path.exists('src.tgz'):
-        local("curl -f -o src.tgz " + sourceurl, capture=False)
+    # A src.tgz in the working directory overrides the download
+    archive = 'src.tgz'
+    if not os.path.exists(archive):
+        pooldir = os.path.join(
+                    os.path.expanduser(_get_cache_option(config, 'dir')), NAME)
+        archive = fetch(sourceurl, pooldir, _get_sha256(config, config_vars))
+        try:
+            _evict(pooldir, archive,
+                   int(_get_cache_option(config, 'tgz_max_mb')) * 1024 * 1024)
+        except OSError as e:
+            log.warning("Unable to evict cached source archives: %s", e)
+
     if not os.path.exists(destdir):
         os.makedirs(destdir)
-    local("tar -C %s -xvf src.tgz" % destdir, capture=False)
+    log.info("Extracting %s to %s", sourceurl, destdir)
+    extract(archive, destdir)
+
+def revision(version, config, env):
+    """Return the source URL, which identifies the tarball untar() extracts
+
+    Tarball URLs are expected to include the version being built.  When a
+    sha256 is configured it is included since it pins the content exactly.
+    """
+    if not version:
+        version = ''
+    config_vars = {'version': version.split('-',1)[0],}
+    sourceurl = config.get(NAME, 'source', False, config_vars)
+    sha256 = _get_sha256(config, config_vars)
+    if sha256:
+        return '%s#sha256=%s' % (sourceurl, sha256.lower())
+    return sourceurl
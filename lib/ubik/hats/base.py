@@ -24,6 +24,7 @@ import textwrap
 import urllib
 
 import ubik.defaults
+import ubik.remote
 
 log = logging.getLogger('ubik.hats.base')
 
@@ -96,6 +97,14 @@ class BaseHat(object):
     def run(self):
         self.runhat()
 
+    def close(self):
+        '''Release resources held for the life of this hat
+
+        This closes the ssh connections that remote commands share, so it
+        should be called once all commands have run.
+        '''
+        ubik.remote.disconnect_all()
+
     def set_options(self, options):
         'Register command line options with this hat'
         self.options = options
@@ -156,7 +165,13 @@ class BaseHat(object):
             pass
 
         cache_dir = self.config.get('cache', 'dir')
-        self.package_cache = ubik.cache.UbikPackageCache(cache_dir)
+        link = self.config.get('cache', 'link')
+        # Zero means no limit
+        max_bytes = int(self.config.get('cache', 'max_mb')) * 1024 * 1024
+        max_age = int(self.config.get('cache', 'max_age_days'))
+        self.package_cache = ubik.cache.UbikPackageCache(cache_dir, link,
+                                                         max_bytes or None,
+                                                         max_age or None)
         return self.package_cache
 
     def _get_infradb(self):
@@ -177,12 +192,32 @@ class BaseHat(object):
 
         confstr = None
         try:
-            if driver == 'dns':
+            if driver in ('dns', 'zone'):
                 confstr = self.config.get('infradb', 'domain')
             elif driver == 'json':
                 confstr = self.config.get('infradb', 'jsonfile')
         except ubik.config.NoOptionError:
             pass
 
-        self.idb = ubik.infra.db.InfraDB(driver, confstr)
+        cache_file = None
+        try:
+            if driver == 'dns':
+                cache_file = self.config.get('infradb', 'cache_file')
+            elif driver == 'zone':
+                cache_file = self.config.get('infradb', 'snapshot')
+        except ubik.config.NoOptionError:
+            pass
+
+        try:
+            zone = self.config.get('infradb', 'zone')
+        except ubik.config.NoOptionError:
+            zone = None
+
+        try:
+            concurrency = int(self.config.get('infradb', 'concurrency'))
+        except ubik.config.NoOptionError:
+            concurrency = ubik.infra.db.LOOKUP_CONCURRENCY
+
+        self.idb = ubik.infra.db.InfraDB(driver, confstr, cache_file,
+                                         concurrency, zone)
         return self.idb
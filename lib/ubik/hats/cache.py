@@ -42,8 +42,7 @@ class CacheHat(BaseHat):
         super(CacheHat, self).__init__(argv, config, options)
         self.args = argv[1:]
 
-        cache_dir = os.path.expanduser(self.config.get('cache','dir'))
-        self.cache = ubik.cache.UbikPackageCache(cache_dir)
+        self.cache = self._get_package_cache()
 
     def run(self):
         # If cache.autoprune is true, run prune anytime a cache
@@ -54,7 +53,7 @@ class CacheHat(BaseHat):
             pass
         else:
             if autoprune.lower() == 'true':
-                self.prune()
+                self.cache.prune(self._keep_packages())
 
         if len(self.args) == 0:
             self.args.insert(0, 'ls')
@@ -85,13 +84,28 @@ class CacheHat(BaseHat):
             self.cache.add(filepath)
         del self.args[:i]
 
+    def import_dirs(self):
+        '''cache import DIR [ DIR ... ]
+
+        Adds every package found in the directory tree DIR to the package
+        cache.  Packages are inspected in parallel and indexed in batches.'''
+        i = 0
+        for path in self.args:
+            i += 1
+            if path == ';':
+                break
+            count = self.cache.import_dir(path)
+            print >>self.output, "Imported %d packages from %s" % (count, path)
+        del self.args[:i]
+
     # TODO: add file command
 
     def last(self):
         '''cache last [ NAME ]
 
         Returns the path to the latest package file for package NAME, as
-        determined by creation date. Defaults to all packages.'''
+        determined by version. If NAME is a pattern or omitted, returns the
+        package most recently added to the cache.'''
         if len(self.args) == 0:
             self.args.insert(0, '*')
         filename = self.cache.get(name=self.args.pop(0))
@@ -112,18 +126,45 @@ class CacheHat(BaseHat):
                 print pkg["filename"]
         del self.args[:i]
 
+    def pin(self):
+        '''cache pin FILENAME
+
+        Keep the file named FILENAME in the package cache even when it's
+        over the cache.max_mb or cache.max_age_days limits.  Deploys pin
+        the packages they deploy.'''
+        i = 0
+        for filename in self.args:
+            i += 1
+            if filename == ';':
+                break
+            self.cache.pin(filename)
+        del self.args[:i]
+
     def prune(self):
         '''cache prune
 
-        Prune contents of cache according to cache.keep_packages setting.
-        Also tidies the index by removing packages that have been deleted
-        on disk.
+        Prune contents of cache according to cache.keep_packages setting,
+        then evict packages according to the cache.max_mb and
+        cache.max_age_days settings.  Also tidies the index by removing
+        packages that have been deleted on disk.  When cache.autoprune is
+        true, every cache command does the same for packages added since
+        the last prune.
         '''
+        self.cache.prune(self._keep_packages(), full=True)
+
+    def _keep_packages(self):
         try:
-            keep_versions = self.config.get('cache', 'keep_packages')
+            return self.config.get('cache', 'keep_packages')
         except ConfigParser.Error:
-            keep_versions = None
-        self.cache.prune(keep_versions)
+            return None
+
+    def reindex(self):
+        '''cache reindex
+
+        Rebuilds the package cache index from the package files in the cache,
+        such as after the index has been lost or corrupted.'''
+        count = self.cache.reindex()
+        print >>self.output, "Indexed %d packages" % count
 
     def remove(self):
         '''cache remove FILENAME
@@ -137,17 +178,35 @@ class CacheHat(BaseHat):
             self.cache.remove(filepath)
         del self.args[:i]
 
-    command_list = ( add, last, ls, prune, remove )
+    def unpin(self):
+        '''cache unpin FILENAME
+
+        Allow the file named FILENAME to be evicted from the package cache
+        again.'''
+        i = 0
+        for filename in self.args:
+            i += 1
+            if filename == ';':
+                break
+            self.cache.unpin(filename)
+        del self.args[:i]
+
+    command_list = ( add, import_dirs, last, ls, pin, prune, reindex, remove,
+                     unpin )
     command_map = {
         'add':      add,
         'del':      remove,
         'delete':   remove,
+        'import':   import_dirs,
         'last':     last,
         'list':     ls,
         'ls':       ls,
+        'pin':      pin,
         'prune':    prune,
+        'reindex':  reindex,
         'remove':   remove,
         'rm':       remove,
+        'unpin':    unpin,
     }
 
 if __name__ == '__main__':
@@ -13,8 +13,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import logging
+import optparse
 import os.path
+import pipes
+import re
 import subprocess
 import tempfile
 
@@ -23,9 +27,9 @@ import ubik.cache
 import ubik.config
 import ubik.defaults
 import ubik.packager
+import ubik.remote
 
-from fabric.api import local, prompt, put, run, settings
-from fabric.state import connections
+from fabric.api import prompt
 
 from ubik.hats import HatException
 from ubik.hats.base import BaseHat
@@ -37,6 +41,27 @@ PKG_INSTALL_CMD = {
     'deb': "fakeroot dpkg -i",
     'rpm': "rpm -U --oldpackage",
 }
+# Commands to query the installed version of a package, which are expected
+# to exit non-zero if it isn't installed
+PKG_VERSION_CMD = {
+    'deb': "dpkg-query -W -f '${Status}\\t${Version}' %s",
+    'rpm': "rpm -q --qf '%%|EPOCH?{%%{EPOCH}:}:{}|%%{VERSION}-%%{RELEASE}' %s",
+}
+# Patterns matching other versions of a package in ~/pkgs
+PKG_FILE_GLOB = {
+    'deb': "%s_*.deb",
+    'rpm': "%s-[0-9]*.rpm",
+}
+SUPCTL_STATUS_CMD = "sup status %s"
+# Used by hosts to fetch a package from another host when seeding.  Hosts
+# may not have seen each other before, so they're given the source host's
+# key as rug's own connection to it saw it (a known_hosts line), and refuse
+# to connect, and forward the agent, to anything else.  The package
+# checksum is verified after every transfer as well.
+FETCH_CMD = ("f=$(mktemp) && echo %s > $f && "
+             "scp -q -o BatchMode=yes -o StrictHostKeyChecking=yes "
+             "-o UserKnownHostsFile=$f %s:pkgs/%s pkgs/; "
+             "s=$?; rm -f $f; exit $s")
 
 class DeployHat(BaseHat):
     "Deployer Hat"
@@ -51,7 +76,29 @@ class DeployHat(BaseHat):
 
     def __init__(self, argv, config=None, options=None):
         super(DeployHat, self).__init__(argv, config, options)
-        self.args = argv[1:]
+
+        cmd_parser = optparse.OptionParser(add_help_option=False)
+        cmd_parser.add_option('--parallel', '-j', type='int', default=None,
+                              help="Deploy to this many hosts at a time")
+        cmd_parser.add_option('--keep-going', '-k', default=False,
+                              action='store_true',
+                              help="Continue deploying after a host fails")
+        cmd_parser.add_option('--batch', '-b', default=None,
+                              help="Roll out to SIZE hosts (or SIZE%) at "
+                                   "a time")
+        cmd_parser.add_option('--by-dc', default=False, action='store_true',
+                              help="Never mix datacenters in a batch")
+        cmd_parser.add_option('--force', '-f', default=False,
+                              action='store_true',
+                              help="Deploy even to hosts that already have "
+                                   "this version installed")
+        cmd_parser.add_option('--delta', default=False, action='store_true',
+                              help="Keep packages on hosts and upload only "
+                                   "the changes from the previous package")
+        cmd_parser.add_option('--seed', default=False, action='store_true',
+                              help="Upload once per datacenter and copy the "
+                                   "package between hosts from there")
+        (self.cmd_options, self.args) = cmd_parser.parse_args(argv[1:])
 
     def run(self):
         if self.args[0] == 'help' or len(self.args) < 2:
@@ -61,10 +108,37 @@ class DeployHat(BaseHat):
 
     # deploy sub-commands
     def deploy(self):
-        '''deploy APP VERSION [ HOST [ HOST ... ] ]
+        '''deploy [ -j N ] [ -k ] [ -f ] [ -b SIZE [ --by-dc ] ] [ --seed ]
+               [ --delta ] APP VERSION [ HOST [ HOST ... ] ]
 
         Deploys an application to a list of hosts.  If hosts are omitted, 
-        attempts to determine host list automatically.
+        attempts to determine host list automatically.  Hosts that already
+        have VERSION installed are skipped unless --force is given or
+        deploy.skip_installed is false.  Up to N hosts
+        (deploy.parallel) are deployed at once.  No new hosts are started
+        after a failure unless --keep-going is given or deploy.on_error is
+        "continue".  A summary of each host is printed at the end.
+
+        With --batch (deploy.batch), hosts are deployed in batches of SIZE
+        hosts, or SIZE percent of the hosts, as a rolling deploy.  With
+        --by-dc (deploy.batch_by_dc) each batch is drawn from a single
+        datacenter.  Every process listed by "sup status" on each host must
+        be RUNNING within deploy.health_timeout seconds before the next
+        batch starts, and the rollout stops after a batch with any failures.
+        With deploy.restart = supervisor, each process must also have been
+        restarted since the deploy started.
+
+        With --seed (deploy.distribution = seed), the package is uploaded
+        only once per datacenter.  Hosts then copy it from hosts that already
+        have it, doubling the number of sources at each step.  This requires
+        ssh agent forwarding to be allowed between hosts.  Hosts only connect
+        to a source whose host key matches the one rug sees, and packages are
+        always checksummed before they are installed.
+
+        With --delta (deploy.delta), the installed package is kept in ~/pkgs
+        on each host and the next deploy uses rsync to upload only what
+        changed from it.  rsync uses ssh directly rather than the connections
+        used by rug, so it needs key based authentication.
         '''
         name, version = self.args[0:2]
 
@@ -120,56 +194,381 @@ class DeployHat(BaseHat):
             return
 
         deploy_user = self.config.get('deploy', 'user')
-        try:
-            for host in hosts:
-                host_pkgtype = host.pkgtype()
-                host_pkgpath = pkgpath[host_pkgtype]
-                host_pkgfilename = os.path.basename(host_pkgpath)
-
-                with settings(host_string=str(host), user=deploy_user):
-                    fab_output = run("mkdir -p pkgs/", shell=False)
-                    if fab_output:
-                        print >>self.output, fab_output
-                    put(host_pkgpath, "pkgs/")
-
-                    pkg_delete = True
-                    if host_pkgtype in PKG_INSTALL_CMD.keys():
-                        fab_output = run(PKG_INSTALL_CMD[host_pkgtype] +
-                                         " pkgs/%s" % host_pkgfilename,
-                                         shell=False)
-                    else:
-                        fab_output = ("Unable to determine install command for "
-                                      "package type %s.  Leaving package "
-                                      "~%s/pkgs/%s for manual install." %
-                                      (host_pkgtype, deploy_user, 
-                                       host_pkgfilename))
-                        pkg_delete = False
-                    if fab_output:
-                        print >>self.output, fab_output
-
-                    if pkg_delete:
-                        fab_output = run("rm pkgs/" + host_pkgfilename, shell=False)
-                        if fab_output:
-                            print >>self.output, fab_output
-
-                    if self.config.get('deploy', 'restart') == 'supervisor':
-                        try:
-                            service = self.config.get('supervisor', 'service')
-                            fab_output = run("sup restart " + service,
-                                             shell=False)
-                            if fab_output:
-                                print >>self.output, fab_output
-                        except ubik.config.NoOptionError:
-                            log.error("supervisor restart specified by config "
-                                      "but supervisor.service option missing.")
-        finally:
-            # TODO: replace with disconnect_all() w/ fabric 0.9.4+
-            for key in connections.keys():
-                connections[key].close()
-                del connections[key]
+        concurrency = self.cmd_options.parallel
+        if concurrency is None:
+            concurrency = int(self.config.get('deploy', 'parallel'))
+        fail_fast = not (self.cmd_options.keep_going or
+                         self.config.get('deploy', 'on_error') == 'continue')
+
+        batch = self.cmd_options.batch or self.config.get('deploy', 'batch')
+        by_dc = (self.cmd_options.by_dc or
+                 self.config.get('deploy', 'batch_by_dc').lower() == 'true')
+        service = None
+        if batch:
+            try:
+                service = self.config.get('supervisor', 'service')
+            except ubik.config.NoOptionError:
+                log.warning("supervisor.service is not set, so batches will "
+                            "not wait for the service to be RUNNING")
+
+        checksums = {}
+        for pkgtype, path in pkgpath.items():
+            checksums[pkgtype] = _sha256sum(path)
+        self.pkginfo = self._inspect_packages(pkgpath)
+        self.delta = (self.cmd_options.delta or
+                      self.config.get('deploy', 'delta').lower() == 'true')
+        skip_installed = (not self.cmd_options.force and self.config.get(
+                            'deploy', 'skip_installed').lower() == 'true')
+
+        restart = self.config.get('deploy', 'restart') == 'supervisor'
+
+        def deploy_host(host):
+            pkgtype = host.pkgtype()
+            host_string = "%s@%s" % (deploy_user, host)
+            before = None
+            if service and restart:
+                before = _supervisor_status(host_string, service)
+            message = self._deploy_host(host, pkgpath[pkgtype],
+                                        checksums[pkgtype], deploy_user,
+                                        upload=not seed)
+            if service:
+                # When supervisor restarts them, the processes that were
+                # already running don't count, so this waits for the
+                # restart as well as for it to succeed
+                ubik.remote.wait_for(host_string, SUPCTL_STATUS_CMD % service,
+                                     lambda output: _restarted(before, output),
+                                     int(self.config.get('deploy',
+                                                         'health_timeout')))
+            return message
+
+        seed = (self.cmd_options.seed or
+                self.config.get('deploy', 'distribution') == 'seed')
+        failures = {}
+        targets = hosts
+        if skip_installed:
+            current = self._installed(hosts, deploy_user, concurrency)
+            failures.update(current)
+            targets = [h for h in hosts if h not in current]
+        if seed and targets:
+            undistributed = self._distribute(targets, pkgpath, checksums,
+                                             deploy_user, concurrency)
+            failures.update(undistributed)
+            if undistributed and fail_fast:
+                log.error("Not deploying since the package could not be "
+                          "distributed to all hosts")
+                targets = []
+        targets = [h for h in targets if h not in failures]
+
+        if batch:
+            results = self._deploy_rolling(targets, deploy_host, batch,
+                                           by_dc, concurrency, fail_fast)
+        else:
+            results = ubik.remote.run_hosts(targets, deploy_host,
+                                            concurrency, fail_fast)
+        for result in results:
+            failures[result.host] = result
+        results = [failures.get(h) or ubik.remote.HostResult(h)
+                   for h in hosts]
+
+        # Don't let the cache evict what's deployed.  The previously
+        # deployed version is released once every host has the new one.
+        for pkgtype, path in pkgpath.items():
+            done = [r.ok for r in results if r.host.pkgtype() == pkgtype]
+            if any(done):
+                cache.pin(os.path.basename(path), exclusive=all(done))
+
+        print >>self.output
+        ubik.remote.print_summary(results, self.output)
+        failed = [r for r in results if not r.ok]
+        if failed:
+            raise HatException("Deploy did not complete on %d of %d hosts" %
+                               (len(failed), len(results)))
+
+    def _deploy_rolling(self, hosts, deploy_host, batch, by_dc, concurrency,
+                        fail_fast):
+        '''Run deploy_host over hosts in batches, stopping after a failure'''
+        key = None
+        if by_dc:
+            key = lambda host: host.domain()
+        host_batches = ubik.remote.batches(hosts, batch, key)
+
+        results = []
+        for i, hostbatch in enumerate(host_batches):
+            if not all(r.ok for r in results):
+                log.error("Halting rollout after failures in batch %d", i)
+                for hostbatch in host_batches[i:]:
+                    results.extend(ubik.remote.HostResult(h)
+                                   for h in hostbatch)
+                break
+            print >>self.output, "Deploying batch %d of %d: %s" % (
+                i + 1, len(host_batches), ' '.join(str(h) for h in hostbatch))
+            results.extend(ubik.remote.run_hosts(hostbatch, deploy_host,
+                                                 concurrency, fail_fast))
+        return results
+
+    def _inspect_packages(self, pkgpath):
+        '''Return a dict of name and version by package type for pkgpath'''
+        pkginfo = {}
+        for pkgtype, path in pkgpath.items():
+            if pkgtype not in PKG_VERSION_CMD:
+                continue
+            try:
+                pkginfo[pkgtype] = ubik.cache.UbikPackageCache._inspect(
+                                    path, pkgtype)
+            except ubik.cache.CacheException as e:
+                log.warning("Unable to inspect %s: %s", path, e)
+        return pkginfo
+
+    def _installed(self, hosts, deploy_user, concurrency):
+        '''Check which hosts already have the packages being deployed
+
+        Returns a dict of HostResult for the hosts that do.  Hosts that can't
+        be checked are assumed to need the package.
+        '''
+        pkginfo = self.pkginfo
+
+        def check(host):
+            pkg = pkginfo[host.pkgtype()]
+            try:
+                output = ubik.remote.execute(
+                            "%s@%s" % (deploy_user, host),
+                            PKG_VERSION_CMD[host.pkgtype()] % pkg['name'])
+            except ubik.remote.RemoteException:
+                return None
+            status, version = ('\t' + output).rsplit('\t', 1)
+            if 'deinstall' in status or 'not-installed' in status:
+                return None
+            return version.strip()
+
+        current = {}
+        print >>self.output, "Checking installed versions"
+        checked = [h for h in hosts if h.pkgtype() in pkginfo]
+        for result in ubik.remote.run_hosts(checked, check, concurrency,
+                                            False):
+            pkg = pkginfo[result.host.pkgtype()]
+            if result.ok and result.message == _full_version(pkg):
+                result.message = "%s %s is already installed" % (
+                                    pkg['name'], _full_version(pkg))
+                current[result.host] = result
+        return current
+
+    def _upload(self, host_string, pkgpath):
+        '''Copy the package at pkgpath to ~/pkgs on host_string'''
+        ubik.remote.execute(host_string, "mkdir -p pkgs/")
+        if self.delta:
+            ubik.remote.sync(host_string, pkgpath, "pkgs/")
+        else:
+            ubik.remote.upload(host_string, pkgpath,
+                               "pkgs/" + os.path.basename(pkgpath))
+
+    def _distribute(self, hosts, pkgpath, checksums, deploy_user,
+                    concurrency):
+        '''Copy packages to ~/pkgs on hosts, uploading once per datacenter
+
+        The package is uploaded to one seed host per datacenter and package
+        type.  Then every host that has the package sends it to another host
+        until all hosts have it.  Returns a dict of HostResult for hosts
+        that didn't receive the package.
+        '''
+        def upload(host):
+            host_string = "%s@%s" % (deploy_user, host)
+            filename = os.path.basename(pkgpath[host.pkgtype()])
+            self._upload(host_string, pkgpath[host.pkgtype()])
+            _verify_checksum(host_string, "pkgs/" + filename,
+                             checksums[host.pkgtype()])
+
+        sources = {}
+        def fetch(host):
+            host_string = "%s@%s" % (deploy_user, host)
+            filename = os.path.basename(pkgpath[host.pkgtype()])
+            source = "%s@%s" % (deploy_user, sources[host])
+            known_host = "%s %s" % (sources[host],
+                                    ubik.remote.host_key(source))
+            ubik.remote.execute(host_string, "mkdir -p pkgs/")
+            ubik.remote.execute(host_string,
+                                FETCH_CMD % (pipes.quote(known_host), source,
+                                             filename),
+                                forward_agent=True)
+            _verify_checksum(host_string, "pkgs/" + filename,
+                             checksums[host.pkgtype()])
+
+        groups = ubik.remote.batches(hosts, '100%',
+                                     lambda h: (h.domain(), h.pkgtype()))
+        have = [[] for group in groups]
+        failures = {}
+
+        # Seed each group, moving on to the next host if a seed fails
+        while True:
+            indexes = [i for i, g in enumerate(groups) if g and not have[i]]
+            if not indexes:
+                break
+            seeds = [groups[i].pop(0) for i in indexes]
+            print >>self.output, "Uploading to seed hosts: %s" % (
+                ' '.join(str(h) for h in seeds))
+            for i, result in zip(indexes, ubik.remote.run_hosts(
+                                    seeds, upload, concurrency, False)):
+                if result.ok:
+                    have[i].append(result.host)
+                else:
+                    failures[result.host] = result
+
+        # Fan out, doubling the number of sources each round
+        while any(groups):
+            sources.clear()
+            targets, indexes = [], []
+            for i, group in enumerate(groups):
+                for source in have[i][:len(group)]:
+                    target = group.pop(0)
+                    sources[target] = source
+                    targets.append(target)
+                    indexes.append(i)
+            print >>self.output, "Copying package to %d hosts" % len(targets)
+            for i, result in zip(indexes, ubik.remote.run_hosts(
+                                    targets, fetch, concurrency, False)):
+                if result.ok:
+                    have[i].append(result.host)
+                else:
+                    failures[result.host] = result
+        return failures
+
+    def _deploy_host(self, host, pkgpath, checksum, deploy_user, upload=True):
+        '''Install the package at pkgpath on a single host
+
+        If upload is False, the package must already be in ~/pkgs on the
+        host.  This is called from multiple threads at once, so it must not
+        use the fabric environment.
+        '''
+        host_string = "%s@%s" % (deploy_user, host)
+        host_pkgtype = host.pkgtype()
+        host_pkgfilename = os.path.basename(pkgpath)
+
+        if upload:
+            self._upload(host_string, pkgpath)
+        _verify_checksum(host_string, "pkgs/" + host_pkgfilename, checksum)
+
+        if host_pkgtype not in PKG_INSTALL_CMD:
+            return ("Unable to determine install command for package type "
+                    "%s.  Leaving package ~%s/pkgs/%s for manual install." %
+                    (host_pkgtype, deploy_user, host_pkgfilename))
+        ubik.remote.execute(host_string, PKG_INSTALL_CMD[host_pkgtype] +
+                            " pkgs/%s" % host_pkgfilename)
+        if self.delta:
+            # Keep this package as the basis for the next delta
+            if host_pkgtype in self.pkginfo:
+                pattern = (PKG_FILE_GLOB[host_pkgtype] %
+                           self.pkginfo[host_pkgtype]['name'])
+                ubik.remote.execute(host_string,
+                                    "find pkgs/ -maxdepth 1 -name '%s' ! "
+                                    "-name '%s' -delete" % (pattern,
+                                                            host_pkgfilename))
+        else:
+            ubik.remote.execute(host_string, "rm pkgs/" + host_pkgfilename)
+
+        if self.config.get('deploy', 'restart') == 'supervisor':
+            try:
+                service = self.config.get('supervisor', 'service')
+            except ubik.config.NoOptionError:
+                log.error("supervisor restart specified by config "
+                          "but supervisor.service option missing.")
+            else:
+                ubik.remote.execute(host_string, "sup restart " + service)
 
     command_list = ( deploy, )
 
+def _full_version(pkg):
+    """Return the version of pkg as PKG_VERSION_CMD reports it once installed
+
+    >>> _full_version({'type': 'deb', 'version': '1:1.0-2'})
+    '1:1.0-2'
+    >>> _full_version({'type': 'rpm', 'version': '1.0', 'release': '2'})
+    '1.0-2'
+    >>> _full_version({'type': 'rpm', 'version': '1.0', 'release': '2',
+    ...                'epoch': '1'})
+    '1:1.0-2'
+    >>>
+
+    """
+    version = pkg['version']
+    if pkg.get('release'):
+        version += '-' + pkg['release']
+    if pkg.get('epoch'):
+        version = pkg['epoch'] + ':' + version
+    return version
+
+def _parse_supervisor_status(output):
+    """Return a dict of (state, pid) by process from sup status output
+
+    >>> sorted(_parse_supervisor_status(
+    ...     'web:web_00   RUNNING   pid 4242, uptime 0:10:03\\n'
+    ...     'web:web_01   STARTING  \\n').items())
+    [('web:web_00', ('RUNNING', '4242')), ('web:web_01', ('STARTING', None))]
+    >>>
+
+    """
+    status = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        m = re.search(r'\bpid (\d+)', line)
+        status[fields[0]] = (fields[1], m and m.group(1))
+    return status
+
+def _supervisor_status(host_string, service):
+    "Return the status of the processes of service on host_string"
+    try:
+        output = ubik.remote.execute(host_string, SUPCTL_STATUS_CMD % service)
+    except ubik.remote.RemoteException as e:
+        # supervisorctl exits non-zero when processes aren't running
+        output = e.output
+    return _parse_supervisor_status(output)
+
+def _restarted(before, output):
+    """Return True if every process in output is RUNNING since before
+
+    before is the status of the processes before the deploy, or None if
+    they needn't have been restarted.  Processes that kept the same pid
+    haven't been restarted.
+
+    >>> _restarted(None, 'web:web_00  RUNNING  pid 4242, uptime 1:00:00')
+    True
+    >>> _restarted(None, 'web:web_00  STARTING')
+    False
+    >>> before = {'web:web_00': ('RUNNING', '4242')}
+    >>> _restarted(before, 'web:web_00  RUNNING  pid 4242, uptime 1:00:00')
+    False
+    >>> _restarted(before, 'web:web_00  RUNNING  pid 4343, uptime 0:00:05\\n'
+    ...                    'web:web_01  BACKOFF  Exited too quickly')
+    False
+    >>> _restarted(before, 'web:web_00  RUNNING  pid 4343, uptime 0:00:05')
+    True
+    >>>
+
+    """
+    status = _parse_supervisor_status(output)
+    if not status:
+        return False
+    for process, (state, pid) in status.items():
+        if state != 'RUNNING':
+            return False
+        if before is not None and pid == before.get(process, (None, None))[1]:
+            return False
+    return True
+
+def _sha256sum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(1024*1024), ''):
+            sha256.update(buf)
+    return sha256.hexdigest()
+
+def _verify_checksum(host_string, path, checksum):
+    "Raise HatException unless the sha256 of path on host_string is checksum"
+    output = ubik.remote.execute(host_string, "sha256sum " + path)
+    if output.split()[0] != checksum:
+        raise HatException("Checksum mismatch for %s on %s" % (path,
+                                                              host_string))
+
 if __name__ == '__main__':
     DeployHat(())
 
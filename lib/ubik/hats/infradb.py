@@ -39,21 +39,7 @@ class InfraDBHat(BaseHat):
         super(InfraDBHat, self).__init__(argv, config, options)
         self.args = argv[:]
 
-        try:
-            driver = config.get('infradb', 'driver')
-        except ubik.config.NoOptionError:
-            driver = 'dns'
-
-        confstr = None
-        try:
-            if driver == 'dns':
-                confstr = config.get('infradb', 'domain')
-            elif driver == 'json':
-                confstr = config.get('infradb', 'jsonfile')
-        except ubik.config.NoOptionError:
-            pass
-
-        self.idb = ubik.infra.db.InfraDB(driver, confstr)
+        self.idb = self._get_infradb()
 
     def run(self):
         try:
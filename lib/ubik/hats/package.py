@@ -13,14 +13,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import Queue
 import logging
+import multiprocessing
 import optparse
 import os.path
 import subprocess
 import tempfile
 
 import ubik.builder
-import ubik.cache
 import ubik.defaults
 import ubik.packager
 
@@ -31,6 +32,13 @@ log = logging.getLogger('ubik.hats.package')
 
 PKGTYPES = ('deb', 'rpm')
 
+def _package_worker(results, pkgr, version):
+    "Build a single package in a child process, reporting back via results"
+    try:
+        results.put((pkgr.pkgtype, pkgr.build(version), None))
+    except BaseException as e:
+        results.put((pkgr.pkgtype, None, str(e) or e.__class__.__name__))
+
 class PackageHat(BaseHat):
     "Packager Hat"
 
@@ -50,6 +58,9 @@ class PackageHat(BaseHat):
         cmd_parser = optparse.OptionParser(add_help_option=False)
         cmd_parser.add_option('--nolint', dest='lint', default=True, action='store_false',
                               help="Do not automatically invoke lint for package")
+        cmd_parser.add_option('--parallel', '-j', default=False,
+                              action='store_true',
+                              help="Build all package types at the same time")
         (self.cmd_options, self.args) = cmd_parser.parse_args(argv[1:])
 
     def run(self):
@@ -58,12 +69,67 @@ class PackageHat(BaseHat):
         else:
             self.package()
 
+    def _package_parallel(self, bob, pkgtypes, version, cache, move=False):
+        '''Build pkgtypes concurrently, one child process per package type
+
+        Every packager shares the same root and FileIndex, but writes its
+        control files to its own scratch directory so that the root is
+        never modified.  Packages are added to the cache as they complete,
+        and moved there if move is true.
+        '''
+        index = ubik.packager.FileIndex(bob.env.rootdir)
+        results = multiprocessing.Queue()
+        procs = {}
+        scratchdirs = []
+        for pkgtype in pkgtypes:
+            scratchdir = tempfile.mkdtemp(prefix='packager-%s-' % pkgtype)
+            scratchdirs.append(scratchdir)
+            pkgr = ubik.packager.Package(bob.pkgcfg, bob.env, pkgtype,
+                                         lint=self.cmd_options.lint,
+                                         index=index, scratchdir=scratchdir)
+            proc = multiprocessing.Process(target=_package_worker,
+                                           args=(results, pkgr, version))
+            proc.start()
+            procs[pkgtype] = proc
+
+        errors = []
+        try:
+            pending = set(pkgtypes)
+            while pending:
+                try:
+                    pkgtype, pkgfile, error = results.get(timeout=1)
+                except Queue.Empty:
+                    # A child that died without reporting will never report
+                    for pkgtype in list(pending):
+                        if not procs[pkgtype].is_alive() and results.empty():
+                            pending.discard(pkgtype)
+                            errors.append("%s: exited with status %s" %
+                                          (pkgtype, procs[pkgtype].exitcode))
+                    continue
+                pending.discard(pkgtype)
+                if error:
+                    log.error("Failed to build %s package: %s", pkgtype, error)
+                    errors.append("%s: %s" % (pkgtype, error))
+                else:
+                    log.debug("Successfully created package file %s", pkgfile)
+                    cache.add(pkgfile, type=pkgtype, version=version,
+                              move=move)
+        finally:
+            for proc in procs.values():
+                proc.join()
+            for scratchdir in scratchdirs:
+                subprocess.check_call(('rm', '-rf', scratchdir))
+
+        if errors:
+            raise HatException("Error building packages: " + '; '.join(errors))
+
     # package sub-commands
     def package(self):
-        '''package [ --nolint ] [ deb|rpm ] APP VERSION
+        '''package [ --nolint ] [ --parallel ] [ deb|rpm ] APP VERSION
 
         Builds version VERSION of app APP, as directed by ini configuration,
-        and add it to the package cache.
+        and add it to the package cache.  With --parallel, all package types
+        are built at the same time from the same build root.
         '''
         if self.argv[0] in PKGTYPES:
             pkgtypes_to_build = (self.argv[0],)
@@ -82,23 +148,38 @@ class PackageHat(BaseHat):
         bob = ubik.builder.Builder(self.config, workdir)
         bob.build_from_config(name, version)
 
-        cache_dir = self.config.get('cache', 'dir')
-        cache = ubik.cache.UbikPackageCache(cache_dir)
+        # After the build_from_config() call above, self.config will contain
+        # all of the configuration for this package
+        pkgtypes = []
         for pkgtype in pkgtypes_to_build:
-            # After the build_from_config() call above, self.config will contain
-            # all of the configuration for this package
             if self.config.has_section(pkgtype):
-                pkgr = ubik.packager.Package(bob.pkgcfg, bob.env, pkgtype,
-                                             lint=self.cmd_options.lint)
-                pkgfile = pkgr.build(version)
-                log.debug("Successfully created package file %s", pkgfile)
-                cache.add(pkgfile, type=pkgtype, version=version)
+                pkgtypes.append(pkgtype)
             else:
                 logf = log.info if len(pkgtypes_to_build) > 1 else log.error
                 logf("Config files does not specify package type '%s'",
                      pkgtype)
 
-        if not (self.options.debug or self.options.workdir):
+        # Packages are moved into the cache when the workdir is temporary
+        keep_workdir = self.options.debug or self.options.workdir
+        cache = self._get_package_cache()
+        if self.cmd_options.parallel and len(pkgtypes) > 1:
+            self._package_parallel(bob, pkgtypes, version, cache,
+                                   not keep_workdir)
+        else:
+            # The root is indexed by the first packager and shared with the
+            # rest
+            index = None
+            for pkgtype in pkgtypes:
+                pkgr = ubik.packager.Package(bob.pkgcfg, bob.env, pkgtype,
+                                             lint=self.cmd_options.lint,
+                                             index=index)
+                pkgfile = pkgr.build(version)
+                index = pkgr.index
+                log.debug("Successfully created package file %s", pkgfile)
+                cache.add(pkgfile, type=pkgtype, version=version,
+                          move=not keep_workdir)
+
+        if not keep_workdir:
             log.info("Removing working directory '%s'", workdir)
             subprocess.check_call(('rm', '-rf', workdir))
 
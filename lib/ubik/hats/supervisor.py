@@ -14,14 +14,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import optparse
 import os.path
 import subprocess
+import sys
 import tempfile
 
 import ubik.defaults
+import ubik.remote
 
-from fabric.api import local, prompt, put, run, settings
-from fabric.state import connections
+from fabric.api import prompt
 
 from ubik.hats import HatException
 from ubik.hats.base import BaseHat
@@ -40,6 +42,12 @@ SUPCTL_CMD_MAP = {
     'stderr': "sup tail %s stderr",
     'stdout': "sup tail %s stdout",
 }
+SUPCTL_FOLLOW_CMD_MAP = {
+    'stderr': "sup tail -f %s stderr",
+    'stdout': "sup tail -f %s stdout",
+}
+# Actions that only report on an application and don't need confirmation
+READONLY_ACTIONS = ('status', 'stderr', 'stdout')
 
 class SupervisorHat(BaseHat):
     "Supervisor Hat"
@@ -54,7 +62,14 @@ class SupervisorHat(BaseHat):
 
     def __init__(self, argv, config=None, options=None):
         super(SupervisorHat, self).__init__(argv, config, options)
-        self.args = argv[1:]
+
+        cmd_parser = optparse.OptionParser(add_help_option=False)
+        cmd_parser.add_option('--parallel', '-j', type='int', default=None,
+                              help="Run on this many hosts at a time")
+        cmd_parser.add_option('--follow', '-f', default=False,
+                              action='store_true',
+                              help="Follow output as it is written")
+        (self.cmd_options, self.args) = cmd_parser.parse_args(argv[1:])
 
     def run(self):
         command = self.argv[0]
@@ -68,14 +83,20 @@ class SupervisorHat(BaseHat):
 
     # supervisor sub-commands
     def supervise(self, pargs):
-        '''supervise ACTION APP [ HOST [ HOST ... ] ]
+        '''supervise [ -j N ] [ -f ] ACTION APP [ HOST [ HOST ... ] ]
 
         Supervises an application to a list of hosts.  If hosts are omitted, 
-        attempts to determine host list automatically.
+        attempts to determine host list automatically.  Up to N hosts
+        (deploy.parallel) are supervised at once.
 
         ACTION may be one of the following:
 
         restart - Restarts the application
+        start - Starts the application
+        stop - Stops the application
+        status - Prints a table of the application's state on each host
+        stderr, stdout - Prints the recent output of the application.  With
+                         -f, follows the output of all hosts at once
         '''
         action, app = pargs[0:2]
 
@@ -103,23 +124,54 @@ class SupervisorHat(BaseHat):
 
         # TODO: Determine actual user via InfraDB
         deploy_user = self.config.get('deploy', 'user')
+        concurrency = self.cmd_options.parallel
+        if concurrency is None:
+            concurrency = int(self.config.get('deploy', 'parallel'))
 
-        print >>self.output, ('Running "%s" on the following hosts:' % cmd)
-        for host in hosts:
-            print >>self.output, "\t%s@%s" % (deploy_user, host)
-        yesno = prompt("Proceed?", default='No')
-        if yesno.strip()[0].upper() != 'Y':
+        if action not in READONLY_ACTIONS:
+            print >>self.output, ('Running "%s" on the following hosts:' % cmd)
+            for host in hosts:
+                print >>self.output, "\t%s@%s" % (deploy_user, host)
+            yesno = prompt("Proceed?", default='No')
+            if yesno.strip()[0].upper() != 'Y':
+                return
+
+        if self.cmd_options.follow and action in SUPCTL_FOLLOW_CMD_MAP:
+            status = ubik.remote.stream(["%s@%s" % (deploy_user, host)
+                                         for host in hosts],
+                                        SUPCTL_FOLLOW_CMD_MAP[action] % app,
+                                        self.output, concurrency)
+            failed = [h for h in status if status[h]]
+            if failed:
+                raise HatException("Unable to follow %s on %s" %
+                                   (action, ', '.join(sorted(failed))))
             return
 
-        try:
-            for host in hosts:
-                with settings(host_string=str(host), user=deploy_user):
-                    fab_output = run(cmd, shell=False)
-        finally:
-            # TODO: replace with disconnect_all() w/ fabric 0.9.4+
-            for key in connections.keys():
-                connections[key].close()
-                del connections[key]
+        def supervise_host(host):
+            host_string = "%s@%s" % (deploy_user, host)
+            try:
+                return ubik.remote.execute(host_string, cmd, quiet=True)
+            except ubik.remote.RemoteException as e:
+                # supervisorctl status exits non-zero for stopped programs
+                if action == 'status' and e.output:
+                    return e.output
+                raise
+
+        results = ubik.remote.run_hosts(hosts, supervise_host, concurrency,
+                                        fail_fast=False)
+        if action == 'status':
+            _print_status(results, self.output)
+        elif action in ('stderr', 'stdout'):
+            for result in results:
+                print >>self.output, "==> %s <==" % result.host
+                print >>self.output, result.message
+        else:
+            ubik.remote.print_summary(results, self.output)
+
+        failed = [r for r in results if not r.ok]
+        if failed:
+            raise HatException('"%s" failed on %d of %d hosts' %
+                               (cmd, len(failed), len(results)))
 
     # supervisor sub-commands
     def add(self, args):
@@ -150,21 +202,23 @@ class SupervisorHat(BaseHat):
 
         Reports the status of an application on a list of hosts.
         '''
-        pass # Command only available via supervise()
+        self.supervise(['status'] + args)
 
     def stderr(self, args):
-        '''sup stderr APP [ HOST [ HOST ... ] ]
+        '''sup stderr [ -f ] APP [ HOST [ HOST ... ] ]
 
-        Reports the output an application has sent to stderr.
+        Reports the output an application has sent to stderr.  With -f,
+        follows the output from all hosts until interrupted.
         '''
-        pass # Command only available via supervise()
+        self.supervise(['stderr'] + args)
 
     def stdout(self, args):
-        '''sup stdout APP [ HOST [ HOST ... ] ]
+        '''sup stdout [ -f ] APP [ HOST [ HOST ... ] ]
 
-        Reports the output an application has sent to stdout.
+        Reports the output an application has sent to stdout.  With -f,
+        follows the output from all hosts until interrupted.
         '''
-        pass # Command only available via supervise()
+        self.supervise(['stdout'] + args)
 
     def stop(self, args):
         '''[sup] stop APP [ HOST [ HOST ... ] ]
@@ -182,6 +236,37 @@ class SupervisorHat(BaseHat):
         'supervise': supervise,
     }
 
+def _print_status(results, out):
+    """Print a table of supervisor status output from many hosts
+
+    >>> r = ubik.remote.HostResult('alpha.dc1')
+    >>> r.status = 'ok'
+    >>> r.message = 'app   RUNNING   pid 1234, uptime 1:02:03'
+    >>> _print_status([r, ubik.remote.HostResult('bravo.dc1')], sys.stdout)
+    HOST                           PROCESS          STATE      DESCRIPTION
+    alpha.dc1                      app              RUNNING    pid 1234, uptime 1:02:03
+    bravo.dc1                      -                UNKNOWN
+    1 RUNNING, 1 UNKNOWN
+    >>>
+
+    """
+    fmt = "%-30s %-16s %-10s %s"
+    print >>out, fmt % ('HOST', 'PROCESS', 'STATE', 'DESCRIPTION')
+    counts = {}
+    for result in results:
+        lines = []
+        if result.ok:
+            lines = [l.split(None, 2) for l in result.message.splitlines()
+                     if l.strip()]
+        if not lines:
+            lines = [['-', 'UNKNOWN', result.message]]
+        for fields in lines:
+            fields = (fields + ['', ''])[:3]
+            counts[fields[1]] = counts.get(fields[1], 0) + 1
+            print >>out, (fmt % tuple([result.host] + fields)).rstrip()
+    print >>out, ', '.join(["%d %s" % (counts[state], state)
+                            for state in sorted(counts)])
+
 if __name__ == '__main__':
     SupervisorHat(())
 
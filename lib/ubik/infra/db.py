@@ -13,10 +13,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import Queue
 import logging
+import sys
+import threading
 
 log = logging.getLogger('infra.db')
 
+# Number of lookups to have in flight at once when resolving many objects
+LOOKUP_CONCURRENCY = 16
+
 OS_PKGTYPE_MAP = {
     'DEFAULT':  'deb',
     'centos':   'rpm',
@@ -28,25 +34,91 @@ OS_PKGTYPE_MAP = {
 class InfraDBException(Exception):
     pass
 
+def pmap(func, items, concurrency=LOOKUP_CONCURRENCY):
+    """Return [func(item) for item in items], calling func from many threads
+
+    Results are in the same order as items.  If func raises for any item, the
+    exception for the earliest such item is raised once all are done.
+
+    >>> pmap(lambda x: x * 2, [3, 1, 2], 2)
+    [6, 2, 4]
+    >>> pmap(lambda x: 1 / x, [1, 0, 2])
+    Traceback (most recent call last):
+        ...
+    ZeroDivisionError: integer division or modulo by zero
+    >>>
+
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    work = Queue.Queue()
+    for index in range(len(items)):
+        work.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception:
+                errors[index] = sys.exc_info()
+
+    threads = []
+    for i in range(min(concurrency, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+    return results
+
 class InfraDB(object):
-    def __init__(self, type=None, confstr=None):
+    def __init__(self, type=None, confstr=None, cache_file=None,
+                 concurrency=LOOKUP_CONCURRENCY, zone=None):
         """Create an InfraDB object
 
         An InfraDB uses some sort of database-ish driver to map one real
         infrastructure object to another for this infrastructure.  For example,
         the 'webserver' role may map to hostA, hostB and hostC
 
+        cache_file is where the dns driver keeps answers between invocations,
+        or where the zone driver keeps its snapshot of the zone.  concurrency
+        is the number of lookups made at once when resolving several hosts or
+        services.  zone is the zone file or zone name the zone driver reads.
+
         >>> db=InfraDB('json', 'tests/infradb.json')
+        >>> db=InfraDB('zone', 'example.com.', zone='tests/named/infradb.zone')
+        >>> db.hosts(('webserver.dc1',))
+        ['InfraHost: alpha.dc1', 'InfraHost: bravo.dc1']
         >>>
 
         """
         log.debug("Initializing driver type %s" % type)
+        self.concurrency = concurrency
         if type == 'dns' or type == None:
             from ubik.infra.infradns import InfraDBDriverDNS
-            self.driver = InfraDBDriverDNS(confstr)
+            self.driver = InfraDBDriverDNS(confstr, cache_file, concurrency)
         elif type == 'json':
             from ubik.infra.infrajson import InfraDBDriverJSON
             self.driver = InfraDBDriverJSON(confstr)
+            # Lookups are in memory, so there's nothing to gain from threads
+            self.concurrency = 1
+        elif type == 'zone':
+            from ubik.infra.infrazone import InfraDBDriverZone
+            self.driver = InfraDBDriverZone(confstr, zone, cache_file)
+            self.concurrency = 1
         else:
             raise InfraDBException('No Such Driver: ' + type)
 
@@ -92,19 +164,22 @@ class InfraDB(object):
         ['InfraHost: alpha.dc1', 'InfraHost: charlie.dc2']
 
         """
-        hosts = []
         log.debug("attempting to expand hostnames for: " + ' '.join(qnames))
-        for qname in qnames:
-            try:
-                hosts.append(self.host(qname))
-            except InfraDBException:
-                # self.host() couldn't find a host named 'qname'
-                # qname could be a service, though, so try that
-                service_hosts = self.hosts(self.driver.resolve_service(qname))
-                if len(service_hosts) > 0:
-                    hosts.extend(service_hosts)
-                else:
-                    raise
+        found = pmap(self.driver.lookup_host, qnames, self.concurrency)
+
+        # qnames that aren't hosts could be services, so try that
+        services = [qname for qname, host in zip(qnames, found) if not host]
+        expanded = dict(zip(services, pmap(self.driver.resolve_service,
+                                           services, self.concurrency)))
+
+        hosts = []
+        for qname, host in zip(qnames, found):
+            if host:
+                hosts.append(InfraHost(host, self.driver))
+            elif expanded[qname]:
+                hosts.extend(self.hosts(expanded[qname]))
+            else:
+                raise InfraDBException("Could not locate host '%s'" % qname)
 
         # Dedupe hosts, but preserve order
         seen = set()
@@ -191,6 +266,10 @@ class InfraObject(object):
     def __unicode__(self):
         return unicode(self._name)
 
+    def __lt__(self, other):
+        "Order by name so that lists of hosts and services sort predictably"
+        return unicode(self) < unicode(other)
+
 class InfraHost(InfraObject):
     """This represents a single host in this infrastructure
 
@@ -223,6 +302,17 @@ class InfraHost(InfraObject):
     def __repr__(self):
         return "'InfraHost: %s'" % self._name
 
+    def domain(self):
+        """Return the subdomain (i.e. datacenter) this host lives in
+
+        >>> db=InfraDB('json', 'tests/infradb.json')
+        >>> db.host('alpha.dc1').domain()
+        u'dc1'
+        >>>
+
+        """
+        return self._name.partition('.')[2]
+
     def pkgtype(self):
         """Return the type of system packages used by this host
 
@@ -279,12 +369,12 @@ class InfraService(InfraObject):
         >>>
 
         """
-        hostlist = []
-        for hoststr in self._driver.resolve_service(self._name):
-            hostattr = self._driver.lookup_host(hoststr)
-            if hostattr:
-                hostlist.append(InfraHost(hostattr, self._driver))
-        return hostlist
+        hoststrs = self._driver.resolve_service(self._name)
+        concurrency = getattr(self._driver, 'concurrency', 1)
+        return [InfraHost(hostattr, self._driver)
+                for hostattr in pmap(self._driver.lookup_host, hoststrs,
+                                     concurrency)
+                if hostattr]
 
 if __name__ == '__main__':
     import doctest
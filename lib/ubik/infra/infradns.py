@@ -15,17 +15,27 @@
 #
 """DNS-backed InfraDB Driver"""
 
+import atexit
+import base64
 import dns.exception
+import dns.message
 import dns.name
+import dns.rdataclass
+import dns.rdatatype
 import dns.resolver
+import json
 import logging
 import os
+import time
 
 from dns.name import Name
+from ubik.infra.db import LOOKUP_CONCURRENCY, pmap
 
 log = logging.getLogger('infra.dns')
 
 SVC_INDEX = '_service._services'
+# How long to remember that a name doesn't exist when the server doesn't say
+NEGATIVE_TTL = 60
 
 def _hsts_for(record):
     "Utility function to return DNS lookup listing hosts for record"
@@ -37,6 +47,40 @@ def _svcs_for(record):
     record_name = dns.name.from_text(record, dns.name.empty)
     return Name(('_service',)).concatenate(record_name)
 
+def _negative_ttl(responses):
+    """Return how long a negative answer in responses may be cached
+
+    As in RFC 2308, this is the lesser of the TTL of the SOA record in the
+    authority section and its minimum field.  NEGATIVE_TTL is used when no
+    response has an SOA record.
+
+    >>> response = dns.message.from_text('''id 1
+    ... flags QR AA RD RA
+    ... rcode NXDOMAIN
+    ... ;QUESTION
+    ... nohost.example.com. IN A
+    ... ;AUTHORITY
+    ... example.com. 300 IN SOA ns1 root 1 3600 600 86400 30
+    ... ''')
+    >>> int(_negative_ttl([response]))
+    30
+    >>> response.authority[0].ttl = 10
+    >>> int(_negative_ttl([response]))
+    10
+    >>> _negative_ttl([])
+    60
+    >>>
+
+    """
+    ttls = []
+    for response in responses:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                ttls.append(min(rrset.ttl, rrset[0].minimum))
+    if not ttls:
+        return NEGATIVE_TTL
+    return min(ttls)
+
 class InfraDBDriverDNS(object):
     """InfraDB DNS Driver class
 
@@ -48,9 +92,15 @@ class InfraDBDriverDNS(object):
     >>>
 
     """
-    def __init__(self, domain=None):
+    def __init__(self, domain=None, cache_file=None,
+                 concurrency=LOOKUP_CONCURRENCY):
         """Initialize a new DNS InfraDB Driver
 
+        Answers are cached in memory for as long as their TTL allows.  If
+        cache_file is given, the cache is also loaded from and saved to that
+        file so that it lasts across invocations.  concurrency is the number
+        of sub-services resolved at once by resolve_service().
+
         >>> idb=InfraDBDriverDNS()
         >>> idb=InfraDBDriverDNS('example.com.')
         >>> idb.root
@@ -62,6 +112,14 @@ class InfraDBDriverDNS(object):
 
         """
         log.debug("Initialize InfraDB DNS driver")
+        self.concurrency = concurrency
+        self.cache = {}
+        self.cache_file = None
+        if cache_file:
+            self.cache_file = os.path.expanduser(cache_file)
+            self._load_cache()
+            atexit.register(self._save_cache)
+
         if 'RUG_RESOLV_CONF' in os.environ:
             self.resolver = dns.resolver.Resolver(os.environ['RUG_RESOLV_CONF'])
             if 'RUG_RESOLV_PORT' in os.environ:
@@ -79,14 +137,89 @@ class InfraDBDriverDNS(object):
                 self.root = dns.name.Name([])
         log.debug("InfraDB DNS driver root " + self.root.to_text())
 
+    def _load_cache(self):
+        "Read unexpired answers from self.cache_file into self.cache"
+        try:
+            with open(self.cache_file) as f:
+                entries = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("Not loading DNS cache %s: %s", self.cache_file, e)
+            return
+
+        now = time.time()
+        for query, qtype, expiration, qname, wire in entries:
+            if expiration <= now:
+                continue
+            answer = None
+            if wire:
+                try:
+                    answer = dns.resolver.Answer(
+                                dns.name.from_text(qname),
+                                dns.rdatatype.from_text(qtype),
+                                dns.rdataclass.IN,
+                                dns.message.from_wire(base64.b64decode(wire)))
+                except dns.exception.DNSException as e:
+                    log.debug("Skipping cached answer for %s: %s", query, e)
+                    continue
+                answer.expiration = expiration
+            self.cache[(query, qtype)] = (expiration, answer)
+        log.debug("Loaded %d answers from %s", len(self.cache),
+                  self.cache_file)
+
+    def _save_cache(self):
+        "Write unexpired answers to self.cache_file"
+        now = time.time()
+        entries = []
+        for (query, qtype), (expiration, answer) in self.cache.items():
+            if expiration <= now:
+                continue
+            qname = wire = None
+            if answer:
+                qname = answer.qname.to_text()
+                wire = base64.b64encode(answer.response.to_wire())
+            entries.append((query, qtype, expiration, qname, wire))
+
+        cache_dir = os.path.dirname(self.cache_file)
+        tmpfile = self.cache_file + '.tmp'
+        try:
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmpfile, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmpfile, self.cache_file)
+        except (IOError, OSError) as e:
+            log.warning("Unable to save DNS cache to %s: %s", self.cache_file,
+                        e)
+
     def _query(self, query, qtype='A'):
-        """Query resolver and return an answer object or None"""
+        """Query resolver and return an answer object or None
+
+        Answers, including the lack of one, are cached until they expire.
+        """
+        key = (unicode(query), qtype)
+        cached = self.cache.get(key)
+        if cached and cached[0] > time.time():
+            return cached[1]
+
+        self.cache[key] = self._query_server(query, qtype)
+        return self.cache[key][1]
+
+    def _query_server(self, query, qtype='A'):
+        """Query resolver and return (expiration, answer object or None)
+
+        Negative answers expire after the TTL given by the server's SOA.
+        """
+        # Only newer versions of dnspython include the responses
+        # in the exceptions for negative answers
+        response = None
         try:
             answer = self.resolver.query(query, qtype, tcp=False)
-        except dns.resolver.NXDOMAIN:
-            return None
-        except dns.resolver.NoAnswer:
+        except dns.resolver.NXDOMAIN as e:
+            responses = getattr(e, 'kwargs', {}).get('responses', {})
+            return (time.time() + _negative_ttl(responses.values()), None)
+        except dns.resolver.NoAnswer as e:
             answer = None
+            response = getattr(e, 'kwargs', {}).get('response')
 
         # dnspython doesn't fallback to TCP, so answer could be too long to
         # fit in a UDP packet and we wouldn't know.  Additionally, the server
@@ -94,9 +227,12 @@ class InfraDBDriverDNS(object):
         if not answer or len(answer) >= 13:
             try:
                 answer = self.resolver.query(query, qtype, tcp=True)
-            except dns.resolver.NoAnswer:
-                pass
-        return answer
+            except dns.resolver.NoAnswer as e:
+                response = getattr(e, 'kwargs', {}).get('response', response)
+        if not answer:
+            ttl = _negative_ttl(filter(None, [response]))
+            return (time.time() + ttl, None)
+        return (answer.expiration, answer)
 
     def _query_txt(self, query):
         "Query resolver for TXT record and return a list of relativized strings"
@@ -298,8 +434,9 @@ class InfraDBDriverDNS(object):
             if 'hosts' in svc:
                 hosts.extend(svc['hosts'])
             if 'services' in svc and svc['services']:
-                for service in svc['services']:
-                    hosts.extend(self.resolve_service(service))
+                for service_hosts in pmap(self.resolve_service,
+                                          svc['services'], self.concurrency):
+                    hosts.extend(service_hosts)
         return hosts
 
 if __name__ == '__main__':
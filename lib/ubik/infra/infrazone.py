@@ -0,0 +1,222 @@
+# Copyright 2012 Lee Verberne <lee@blarg.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""InfraDB Driver answering from a snapshot of the whole DNS zone"""
+
+import dns.exception
+import dns.message
+import dns.name
+import dns.query
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+import dns.zone
+import json
+import logging
+import os
+
+from dns.name import Name
+from ubik.infra.infradns import InfraDBDriverDNS
+
+log = logging.getLogger('infra.zone')
+
+# Longest chain of CNAMEs that will be followed within the zone
+MAX_CNAMES = 16
+
+class InfraDBDriverZone(InfraDBDriverDNS):
+    """InfraDB Zone Driver class
+
+    This provides the same InfraDB as the DNS driver, but rather than making
+    several queries per host it reads the entire zone at once, either from a
+    zone file or by zone transfer (AXFR), and answers every query locally.
+
+    >>> idb=InfraDBDriverZone('example.com.', 'tests/named/infradb.zone')
+    >>> sorted(idb.list_services('dc1'))
+    [u'mailserver.dc1', u'webserver.dc1']
+    >>> sorted(idb.resolve_service('webserver'))
+    [u'alpha.dc1', u'bravo.dc1', u'charlie.dc2', u'delta.dc3']
+    >>>
+
+    """
+    def __init__(self, domain=None, zone=None, snapshot=None):
+        """Initialize a new Zone InfraDB Driver
+
+        zone is either the path of a zone file or the name of a zone to
+        transfer from the resolver's first nameserver, which defaults to
+        domain.  Transferred zones are saved to the snapshot file, if given,
+        and the snapshot is used instead of another transfer for as long as
+        the zone's SOA serial stays the same.  Relative names are relative
+        to domain.
+
+        >>> idb=InfraDBDriverZone('example.com.', 'tests/named/infradb.zone')
+        >>> idb.serial
+        1
+        >>>
+
+        """
+        super(InfraDBDriverZone, self).__init__(domain, concurrency=1)
+        log.debug("Initialize InfraDB Zone driver")
+        self.zone = zone or self.root.to_text()
+        self.snapshot = None
+        if snapshot:
+            self.snapshot = os.path.expanduser(snapshot)
+        self.rrsets = {}
+        self.serial = None
+
+        zonefile = os.path.expanduser(self.zone)
+        if os.path.isfile(zonefile):
+            log.debug("Reading zone file %s", zonefile)
+            self._index(dns.zone.from_file(zonefile, relativize=False))
+        else:
+            self._load_zone(dns.name.from_text(self.zone))
+        log.debug("InfraDB zone serial %s has %d rrsets", self.serial,
+                  len(self.rrsets))
+
+    def _index(self, zone):
+        "Index the rrsets of a dns.zone.Zone by (name, rdtype)"
+        self.rrsets = {}
+        for name, node in zone.nodes.items():
+            name = name.derelativize(zone.origin)
+            for rdataset in node.rdatasets:
+                rrset = dns.rrset.RRset(name, rdataset.rdclass,
+                                        rdataset.rdtype)
+                rrset.update(rdataset)
+                self.rrsets[(name, rdataset.rdtype)] = rrset
+        soa = self.rrsets[(zone.origin, dns.rdatatype.SOA)]
+        self.serial = int(soa[0].serial)
+
+    def _load_zone(self, origin):
+        "Load zone origin from the snapshot, transferring it if out of date"
+        try:
+            answer = self.resolver.query(origin, 'SOA')
+            serial = answer[0].serial
+        except dns.exception.DNSException as e:
+            log.warning("Unable to look up SOA for %s: %s", origin, e)
+            serial = None
+
+        if self._read_snapshot(origin, serial):
+            log.debug("Using snapshot of %s serial %s", origin, self.serial)
+            return
+
+        nameserver = self.resolver.nameservers[0]
+        log.info("Transferring zone %s from %s", origin, nameserver)
+        try:
+            zone = dns.zone.from_xfr(dns.query.xfr(nameserver, origin,
+                                                   port=self.resolver.port,
+                                                   relativize=False),
+                                     relativize=False)
+        except (dns.exception.DNSException, EnvironmentError) as e:
+            # An outdated snapshot is better than nothing at all
+            if serial is None or not self._read_snapshot(origin):
+                raise
+            log.warning("Zone transfer failed, using snapshot serial %s: %s",
+                        self.serial, e)
+            return
+        self._index(zone)
+        self._write_snapshot(origin)
+
+    def _read_snapshot(self, origin, serial=None):
+        """Load self.snapshot if it's of zone origin
+
+        If serial is given, the snapshot must also be of that serial.
+        Returns True if the snapshot was loaded.
+        """
+        if not self.snapshot:
+            return False
+        try:
+            with open(self.snapshot) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("Not reading snapshot %s: %s", self.snapshot, e)
+            return False
+        if (dns.name.from_text(data['origin']) != origin or
+                (serial is not None and data['serial'] != serial)):
+            return False
+
+        rrsets = {}
+        for name, ttl, rdtype, rdatas in data['rrsets']:
+            rrset = dns.rrset.from_text_list(dns.name.from_text(name, origin),
+                                             ttl, dns.rdataclass.IN, rdtype,
+                                             rdatas)
+            rrsets[(rrset.name, rrset.rdtype)] = rrset
+        self.rrsets = rrsets
+        self.serial = data['serial']
+        return True
+
+    def _write_snapshot(self, origin):
+        "Save the zone to self.snapshot, with names relative to origin"
+        if not self.snapshot:
+            return
+        rrsets = []
+        for rrset in self.rrsets.values():
+            rrsets.append((rrset.name.relativize(origin).to_text(), rrset.ttl,
+                           dns.rdatatype.to_text(rrset.rdtype),
+                           [rdata.to_text() for rdata in rrset]))
+        data = {'origin': origin.to_text(), 'serial': self.serial,
+                'rrsets': rrsets}
+
+        snapshot_dir = os.path.dirname(self.snapshot)
+        tmpfile = self.snapshot + '.tmp'
+        try:
+            if snapshot_dir and not os.path.exists(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            with open(tmpfile, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.rename(tmpfile, self.snapshot)
+        except (IOError, OSError) as e:
+            log.warning("Unable to save zone snapshot to %s: %s",
+                        self.snapshot, e)
+
+    def _query(self, query, qtype='A'):
+        """Answer a query from the zone and return an answer object or None
+
+        Relative names are relative to self.root and CNAMEs are followed as
+        long as they stay within the zone.
+
+        >>> idb=InfraDBDriverZone('example.com.', 'tests/named/infradb.zone')
+        >>> [a.address for a in idb._query('alpha.dc1')]
+        ['127.0.1.1']
+        >>> idb._query('webserver').canonical_name
+        <DNS name ns.>
+        >>> idb._query('bogus')
+        >>>
+
+        """
+        if not isinstance(query, Name):
+            query = dns.name.from_text(query, None)
+        if not query.is_absolute():
+            query = query.concatenate(self.root)
+        rdtype = dns.rdatatype.from_text(qtype)
+
+        response = dns.message.make_response(
+                        dns.message.make_query(query, rdtype))
+        name = query
+        for i in range(MAX_CNAMES):
+            rrset = (self.rrsets.get((name, rdtype)) or
+                     self.rrsets.get((name, dns.rdatatype.CNAME)))
+            if not rrset:
+                return None
+            response.find_rrset(response.answer, rrset.name, rrset.rdclass,
+                                rrset.rdtype, create=True).update(rrset)
+            if rrset.rdtype == rdtype:
+                return dns.resolver.Answer(query, rdtype, dns.rdataclass.IN,
+                                           response)
+            name = rrset[0].target
+        return None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS, verbose=False)
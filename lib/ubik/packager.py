@@ -17,20 +17,30 @@
 
 import ConfigParser
 import glob
+import hashlib
 import json
 import logging
 import os, os.path
+import pipes
 import platform
 import re
 import shutil as sh
+import stat
 import tempfile
+import time
 
+from array import array
 from fabric.api import *
+from multiprocessing.pool import ThreadPool
 
 import builder
 import ubik.config
+import ubik.debfile
 
 FAKESTATE='_fakestate'
+FAKEPERMS_BATCH=256
+MD5_BUFSIZE=1024*1024
+MD5_THREADS=4
 USERINI='~/.rug/rug.ini'
 
 log = logging.getLogger('ubik.packager')
@@ -59,7 +69,181 @@ def _split_version(combined_version):
         return (version_release[0], '1')
     return version_release
 
-def Package(configfile, env, pkgtype='deb', lint=True):
+def _md5sum(path, bufsize=MD5_BUFSIZE):
+    """Return the md5 hexdigest of the file at path, along with its size
+
+    The file is read in chunks of bufsize so that large files are never held
+    in memory.  hashlib releases the GIL while digesting, so this is safe to
+    call from several threads at once.
+
+    >>> _md5sum('tests/root/opt/dirA/fileA-1')
+    ('f5c85408e67ef9a90f3e416863ba84de', 447)
+    >>>
+
+    """
+    md5 = hashlib.md5()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            md5.update(buf)
+            size += len(buf)
+    return md5.hexdigest(), size
+
+def _timed_md5sum(path):
+    "Wrapper for _md5sum() that also returns the time spent digesting"
+    start = time.time()
+    digest, size = _md5sum(path)
+    return digest, size, time.time() - start
+
+def md5sums(rootdir, filenames, threads=1):
+    """Generate (filename, md5 hexdigest) tuples for filenames under rootdir
+
+    Results are generated in the same order as filenames regardless of the
+    number of threads used to compute them.  When debug logging is enabled,
+    per-file timings and overall throughput are logged.
+
+    >>> list(md5sums('tests/root', ['opt/dirA/fileA-1', 'opt/dirB/fileB-2'],
+    ...              threads=2))  #doctest: +NORMALIZE_WHITESPACE
+    [('opt/dirA/fileA-1', 'f5c85408e67ef9a90f3e416863ba84de'),
+     ('opt/dirB/fileB-2', 'f5c85408e67ef9a90f3e416863ba84de')]
+    >>>
+
+    """
+    paths = [os.path.join(rootdir, f) for f in filenames]
+    debug = log.isEnabledFor(logging.DEBUG)
+    start = time.time()
+    pool = None
+    if threads > 1 and len(paths) > 1:
+        pool = ThreadPool(min(threads, len(paths)))
+        results = pool.imap(_timed_md5sum, paths, 16)
+    else:
+        results = (_timed_md5sum(p) for p in paths)
+
+    total_bytes = 0
+    try:
+        for filename, (digest, size, elapsed) in zip(filenames, results):
+            if debug:
+                log.debug("md5 %s: %d bytes in %.4fs", filename, size, elapsed)
+            total_bytes += size
+            yield filename, digest
+    finally:
+        if pool:
+            pool.terminate()
+
+    if debug:
+        elapsed = time.time() - start
+        log.debug("md5 digested %d files, %d bytes in %.2fs (%.0f bytes/sec)",
+                  len(paths), total_bytes, elapsed,
+                  total_bytes / elapsed if elapsed else 0)
+
+class FileIndex(object):
+    """Index of every path under a package root, built from a single walk
+
+    Each directory is listed once and each entry is lstat()ed once.  Mode,
+    size and inode are kept in parallel arrays indexed by position in
+    self.paths, and link targets are kept in a sparse dict.  Paths are
+    relative to rootdir and the root itself is entry 0, with a path of ''.
+
+    >>> idx = FileIndex('tests/root')
+    >>> idx.paths  #doctest: +NORMALIZE_WHITESPACE
+    ['', 'opt', 'opt/dirA', 'opt/dirB', 'opt/dirA/fileA-1', 'opt/dirA/fileA-2',
+     'opt/dirB/fileB-2']
+    >>> idx.total_size()
+    1341
+    >>> idx.filelist()  #doctest: +NORMALIZE_WHITESPACE
+    [['opt/dirA/fileA-1', {}], ['opt/dirA/fileA-2', {}],
+     ['opt/dirB/fileB-2', {}]]
+    >>>
+
+    """
+    EMPTY = 1
+
+    def __init__(self, rootdir):
+        self.rootdir = rootdir
+        self.paths = []
+        self.modes = array('L')
+        self.sizes = array('L')
+        self.inodes = array('L')
+        self.flags = array('B')
+        self.links = {}
+        self._walk()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _add(self, relpath, st):
+        self.paths.append(relpath)
+        self.modes.append(st.st_mode)
+        self.sizes.append(st.st_size)
+        self.inodes.append(st.st_ino)
+        self.flags.append(0)
+        return len(self.paths) - 1
+
+    def _walk(self):
+        start = time.time()
+        stack = [self._add('', os.lstat(self.rootdir))]
+        while stack:
+            i = stack.pop()
+            reldir = self.paths[i]
+            absdir = os.path.join(self.rootdir, reldir)
+            names = sorted(os.listdir(absdir))
+            if not names:
+                self.flags[i] |= self.EMPTY
+            subdirs = []
+            for name in names:
+                abspath = os.path.join(absdir, name)
+                j = self._add(os.path.join(reldir, name), os.lstat(abspath))
+                if stat.S_ISLNK(self.modes[j]):
+                    self.links[j] = os.readlink(abspath)
+                elif stat.S_ISDIR(self.modes[j]):
+                    subdirs.append(j)
+            # pop() takes from the end, so reverse to keep walk order sorted
+            stack.extend(reversed(subdirs))
+        log.debug("Indexed %d paths under %s in %.2fs", len(self.paths),
+                  self.rootdir, time.time() - start)
+
+    def isdir(self, i):
+        return stat.S_ISDIR(self.modes[i])
+
+    def islink(self, i):
+        return i in self.links
+
+    def total_size(self):
+        "Return the sum of sizes of all regular files"
+        return int(sum(self.sizes[i] for i in xrange(len(self.paths))
+                       if stat.S_ISREG(self.modes[i])))
+
+    def filelist(self, noconf=False):
+        """Return a filelist as used by BasePackage._get_filelist()
+
+        Directories are only listed when empty, since in rpm-land it's
+        important not to claim directories you don't own because they could
+        be removed with the package.  Files with 'etc' in their path are
+        marked as conffiles unless noconf is set.
+        """
+        filelist = []
+        for i, path in enumerate(self.paths):
+            isdir = self.isdir(i)
+            if isdir and not self.flags[i] & self.EMPTY:
+                continue
+            if isdir:
+                opts = ('dir',)
+                parent = path
+            else:
+                opts = ()
+                parent = os.path.dirname(path)
+            if not noconf and 'etc' in parent.split('/'):
+                opts += ('conf',)
+            if self.islink(i):
+                opts += ('link',)
+            filelist.append([path, dict.fromkeys(opts, True)])
+        return filelist
+
+def Package(configfile, env, pkgtype='deb', lint=True, index=None,
+            scratchdir=None):
     """Return the appropriate packager for a given pkgtype
 
     >>> p=Package('tests/package.ini', builder.BuildEnv(), 'deb')
@@ -70,20 +254,30 @@ def Package(configfile, env, pkgtype='deb', lint=True):
     True
     >>>
 
+    index is an optional FileIndex of env.rootdir, which may be shared
+    between packagers to avoid walking the same root more than once.
+
+    If scratchdir is given, control files and specs are written there and
+    nothing is written to env.rootdir.  This allows several packagers to
+    build from the same root at the same time.
+
     """
     if pkgtype == 'deb':
-        return DebPackage(configfile, env, lint)
+        return DebPackage(configfile, env, lint, index, scratchdir)
     elif pkgtype == 'rpm':
-        return RpmPackage(configfile, env, lint)
+        return RpmPackage(configfile, env, lint, index, scratchdir)
     else:
         warn("Package type == %s?!  You're crazy, man.  I like you, "
              "but you're crazy." % pkgtype)
 
 class BasePackage(object):
-    def __init__(self, config, env, lint=True):
+    def __init__(self, config, env, lint=True, index=None, scratchdir=None):
         self.filename = None
         self.env = env
         self.lint = lint
+        self.index = index
+        self.scratchdir = scratchdir
+        self._filelist = None
         if isinstance(config, ConfigParser.SafeConfigParser):
             self.config = config
         else:
@@ -118,36 +312,15 @@ class BasePackage(object):
         return "%s: %s\n" % (name, self._conf_getp(option))
 
     def _gen_filelist(self):
-        rootdir = self.env.rootdir
-        noconf = self._conf_getpb('noconffiles')
-        filelist = []
-        if not rootdir.endswith('/'):
-            rootdir += '/'
-        for root, dirs, files in os.walk(rootdir):
-            relroot = root.split(rootdir, 1)[1]
-            if not noconf and 'etc' in root.split('/'):
-                opts = ('conf',)
-            else:
-                opts = ()
-            # Warning: in rpm-land it's important not to claim directories you
-            # don't own because they could be removed with the package
-            if len(dirs) == 0 and len(files) == 0:
-                filelist.append([relroot, dict.fromkeys(opts + ('dir',), True)])
-            for dir in dirs:
-                if os.path.islink(os.path.join(root, dir)):
-                    filelist.append([os.path.join(relroot, dir),
-                                     dict.fromkeys(opts + ('link',), True)])
-            for file in files:
-                fileopts = opts
-                if os.path.islink(os.path.join(root, file)):
-                    fileopts += ('link',)
-                filelist.append([os.path.join(relroot, file), 
-                                 dict.fromkeys(fileopts, True)])
-        return filelist
+        if not self.index:
+            self.index = FileIndex(self.env.rootdir)
+        return self.index.filelist(self._conf_getpb('noconffiles'))
 
     def _get_filelist(self):
-        config = self.config
-        rootdir = self.env.rootdir
+        'Return the filelist, which is only generated once per packager'
+        if self._filelist is not None:
+            return self._filelist
+
         try:
             filelist_file = self._conf_getp('filelist')
         except ConfigParser.NoOptionError:
@@ -155,11 +328,11 @@ class BasePackage(object):
 
         if filelist_file:
             with open(filelist_file) as file:
-                filelist = json.load(file)
+                self._filelist = json.load(file)
         else:
-            filelist = self._gen_filelist()
+            self._filelist = self._gen_filelist()
 
-        return filelist
+        return self._filelist
 
     def clean(self):
         '''Removes package and root dir'''
@@ -182,6 +355,7 @@ class DebPackage(BasePackage):
 
     >>> if not os.path.exists('tests/out'):
     ...   os.mkdir('tests/out')
+    >>> cwd = os.getcwd()
     >>> os.chdir('tests/out')
     >>> env=builder.BuildEnv(rootdir='../root')
     >>> pkgr=DebPackage('../package.ini', env)
@@ -191,21 +365,28 @@ class DebPackage(BasePackage):
     [localhost] ...
     >>> os.path.basename(pkg)
     'packager-test_1.0_amd64.deb'
+    >>> os.chdir(cwd)
     >>>
 
     """
     pkgtype = 'deb'
 
+    def _debdir(self):
+        'Return the DEBIAN control dir, which is in scratchdir if set'
+        if self.scratchdir:
+            return os.path.join(self.scratchdir, 'DEBIAN')
+        return os.path.join(self.env.rootdir, 'DEBIAN')
+
     def _write_deb_conffiles(self, filelist):
         conffiles = [cf for cf,opts in filelist if opts.get('conf') 
                      and not opts.get('dir')]
-        with open(os.path.join(self.env.rootdir, 'DEBIAN', 'conffiles'), 'w') as f:
+        with open(os.path.join(self._debdir(), 'conffiles'), 'w') as f:
             for cf in conffiles:
                 f.write('/' + cf + '\n')
 
     def _write_deb_control(self, version):
         config = self.config
-        debdir = os.path.join(self.env.rootdir, 'DEBIAN')
+        debdir = self._debdir()
         if not os.path.exists(debdir):
             os.mkdir(debdir)
         # All items in config2control_trans are copied from the package config
@@ -250,31 +431,33 @@ class DebPackage(BasePackage):
                 sh.copy(self._conf_getp(script), os.path.join(debdir, script))
 
     def _write_deb_md5sums(self, filelist):
-        debdir = os.path.join(self.env.rootdir, 'DEBIAN')
+        debdir = self._debdir()
         if not os.path.exists(debdir):
             os.mkdir(debdir)
+        try:
+            threads = int(self._conf_getp('md5_threads'))
+        except ConfigParser.NoOptionError:
+            threads = MD5_THREADS
 
-        with open(os.path.join(debdir, 'md5sums'), 'w') as md5sums:
-            prevdir = os.getcwd()
-            os.chdir(self.env.rootdir)
-            try:
-                for filename, options in filelist:
-                    if not options.get('dir') and not options.get('link'):
-                        md5str = local("md5sum '%s'" % filename, capture=True)
-                        print >>md5sums, md5str
-            finally:
-                os.chdir(prevdir)
+        filenames = [f for f, opts in filelist
+                     if not opts.get('dir') and not opts.get('link')]
+        with open(os.path.join(debdir, 'md5sums'), 'w') as md5file:
+            for filename, digest in md5sums(self.env.rootdir, filenames,
+                                            threads):
+                md5file.write('%s  %s\n' % (digest, filename))
 
-    # Runs before DEBIAN/ is created
-    def _write_fake_perms(self, filelist):
-        log.debug("Faking permissions in advance of deb creation")
-        # If there's a default user or group, go ahead and set it recursively
+    def _default_ownership(self):
+        """Return (owner, group, prefix) for package-wide file ownership
+
+        owner and group are '' when not configured.  Default ownership only
+        applies to prefix and the files below it.
+        """
         try:
             owner = self._conf_getp('owner')
         except ConfigParser.NoOptionError:
             owner = ''
         try:
-            group = ':' + self._conf_getp('group')
+            group = self._conf_getp('group')
         except ConfigParser.NoOptionError:
             group = ''
         # if there's a prefix in the package or builder section, only set
@@ -283,16 +466,62 @@ class DebPackage(BasePackage):
         prefix = ''
         for section in self.pkgtype, 'package', 'svnant':
             if self.config.has_option(section, 'prefix'):
-                prefix = self._conf_getp(section, 'prefix')
+                prefix = self.config.get(section, 'prefix')
                 break
+        return owner, group, prefix.strip('/')
+
+    def _native_entries(self, filelist):
+        """Return data archive entries for debfile.write_deb()
+
+        This applies the same ownership and mode rules as _write_fake_perms()
+        but computes them directly from the filelist, so no fakeroot state is
+        needed.  Parent directories are derived from the filelist rather than
+        walking rootdir again.
+        """
+        owner, group, prefix = self._default_ownership()
+        paths = {'': {}}
+        for filename, options in filelist:
+            filename = filename.strip('/')
+            paths[filename] = options
+            parent = os.path.dirname(filename)
+            while parent not in paths:
+                paths[parent] = {}
+                parent = os.path.dirname(parent)
+
+        entries = []
+        for path in sorted(paths):
+            options = paths[path]
+            path_owner, path_group = 'root', 'root'
+            if (path + '/').startswith(prefix + '/') or not prefix:
+                path_owner = owner or path_owner
+                path_group = group or path_group
+            mode = options.get('mode')
+            if mode is not None:
+                mode = int(str(mode), 8)
+            entries.append((path, options.get('owner', path_owner),
+                            options.get('group', path_group), mode))
+        return entries
+
+    # Runs before DEBIAN/ is created
+    def _write_fake_perms(self, filelist):
+        log.debug("Faking permissions in advance of deb creation")
+        # If there's a default user or group, go ahead and set it recursively
+        owner, group, prefix = self._default_ownership()
+        if group:
+            group = ':' + group
+
+        # All ownership and mode changes are collected into a single script
+        # that is run by one fakeroot session.  Starting fakeroot once per
+        # file means reloading and rewriting FAKESTATE every time.
+        commands = []
         if owner or group:
-            local("fakeroot -s %s -- chown -R %s%s '%s'" %
-                  (FAKESTATE, owner, group, 
-                   os.path.join(self.env.rootdir, prefix.strip('/'))),
-                  capture=False)
+            commands.append(('chown', '-R', owner + group,
+                             os.path.join(self.env.rootdir, prefix)))
 
-        # per-file settings from filelist
-        loadstate = ''
+        # per-file settings from filelist, grouped so that each chown/chmod
+        # handles many files.  chown runs first since it may reset mode bits.
+        chowns = {}
+        chmods = {}
         for filename, options in filelist:
             usergroup = ''
             if 'owner' in options:
@@ -300,63 +529,117 @@ class DebPackage(BasePackage):
             if 'group' in options:
                 usergroup += ':' + options['group']
 
-            # if usergroup or mode is not null, then we've got changes to make
-            # Optimization: don't stat FAKESTATE if loadstate is already set
-            if not loadstate and ((usergroup or 'mode' in options) and
-               os.path.exists(FAKESTATE)):
-                loadstate = ' -i ' + FAKESTATE
+            filepath = os.path.join(self.env.rootdir, filename)
             if usergroup:
-                local("fakeroot -s %s%s -- chown -h %s '%s'" %
-                      (FAKESTATE, loadstate, usergroup, 
-                       os.path.join(self.env.rootdir, filename)),
-                      capture=False)
-            if not loadstate and ((usergroup or 'mode' in options) and
-               os.path.exists(FAKESTATE)):
-                loadstate = ' -i ' + FAKESTATE
+                chowns.setdefault(usergroup, []).append(filepath)
             if 'mode' in options:
-                local("fakeroot -s %s%s -- chmod %s '%s'" %
-                      (FAKESTATE, loadstate, options['mode'],
-                       os.path.join(self.env.rootdir, filename)),
-                      capture=False)
+                chmods.setdefault(str(options['mode']), []).append(filepath)
+        for command, changes in (('chown -h', chowns), ('chmod', chmods)):
+            for value, paths in sorted(changes.items()):
+                for i in range(0, len(paths), FAKEPERMS_BATCH):
+                    commands.append(tuple(command.split()) + (value,) +
+                                    tuple(paths[i:i + FAKEPERMS_BATCH]))
+
+        if not commands:
+            return
+        loadstate = ''
+        if not (owner or group) and os.path.exists(FAKESTATE):
+            loadstate = ' -i ' + FAKESTATE
 
-    def _write_debian_dir(self, version):
-        '''Creates the DEBIAN dir in rootdir'''
+        fd, script = tempfile.mkstemp(prefix='fakeperms-', suffix='.sh')
+        try:
+            with os.fdopen(fd, 'w') as sf:
+                for command in commands:
+                    sf.write(' '.join(pipes.quote(c) for c in command) + '\n')
+            log.debug("Applying %d permission commands in one fakeroot",
+                      len(commands))
+            local("fakeroot -s %s%s -- sh -e '%s'" %
+                  (FAKESTATE, loadstate, script), capture=False)
+        finally:
+            os.unlink(script)
+
+    def _write_debian_dir(self, version, fakeperms=True):
+        '''Creates the DEBIAN dir and returns the filelist used'''
         filelist = self._get_filelist()
-        debdir = os.path.join(self.env.rootdir, 'DEBIAN')
+        debdir = self._debdir()
         # If the dir already exists it's generally due to a previous failed build
         if os.path.exists(debdir):
             log.info("%s exists.  Removing and re-creating.", debdir)
             local("rm -r '%s'" % debdir, capture=False)
         os.mkdir(debdir)
-        self._write_fake_perms(filelist)
+        if fakeperms:
+            self._write_fake_perms(filelist)
         self._write_deb_md5sums(filelist)
         self._write_deb_conffiles(filelist)
         self._write_deb_control(version)
+        return filelist
+
+    def _build_native(self, version):
+        '''Writes the deb with ubik.debfile rather than fakeroot & dpkg -b'''
+        rootdir = self.env.rootdir
+        debdir = self._debdir()
+        filelist = self._write_debian_dir(version, fakeperms=False)
+
+        control = {}
+        with open(os.path.join(debdir, 'control')) as cf:
+            for line in cf:
+                if ':' in line and not line.startswith(' '):
+                    field, value = line.split(':', 1)
+                    control[field] = value.strip()
+        # dpkg leaves the epoch out of the filename
+        filename = '%s_%s_%s.deb' % (control['Package'],
+                                     version.split(':', 1)[-1],
+                                     control['Architecture'])
+        ubik.debfile.write_deb(filename, debdir, rootdir,
+                               self._native_entries(filelist))
+        return os.path.abspath(filename)
 
     def build(self, version):
         '''Creates deployable packages in the current dir from files in rootdir
 
         Note that a directory named rootdir/DEBIAN will be created and
-        removed afterward.'''
+        removed afterward, unless scratchdir is set.
+
+        By default the package is assembled by dpkg -b running under
+        fakeroot.  Setting the deb "writer" option to "native" writes the
+        archive directly with ubik.debfile instead, which needs neither.
+        Since dpkg -b needs DEBIAN inside the root, the native writer is
+        always used with a scratchdir.'''
         log.debug("Building debian package version %s", version)
         rootdir = self.env.rootdir
         config = self.config
 
-        self._write_debian_dir(version)
-
-        fakeoptions = '--'
-        if os.path.exists(FAKESTATE):
-            fakeoptions = '-i ' + FAKESTATE + ' ' + fakeoptions
-        output = local("fakeroot %s dpkg -b '%s' ." % (fakeoptions, rootdir), 
-              capture=True)
-        log.debug(output)
+        try:
+            writer = self._conf_getp('writer')
+        except ConfigParser.NoOptionError:
+            writer = 'dpkg'
+        if self.scratchdir and writer != 'native':
+            log.info("Using native deb writer to leave %s untouched", rootdir)
+            writer = 'native'
 
-        m = re.match("dpkg-deb: building package \S+ in `(\S+)'", output)
-        if m and os.path.exists(m.group(1)):
-            self.filename = os.path.abspath(m.group(1))
-        else:
-            raise PackagerError("Error creating debian package")
-        local("rm -r '%s'" % os.path.join(rootdir, 'DEBIAN'), capture=False)
+        try:
+            if writer == 'native':
+                self.filename = self._build_native(version)
+            else:
+                self._write_debian_dir(version)
+
+                fakeoptions = '--'
+                if os.path.exists(FAKESTATE):
+                    fakeoptions = '-i ' + FAKESTATE + ' ' + fakeoptions
+                output = local("fakeroot %s dpkg -b '%s' ." %
+                               (fakeoptions, rootdir), capture=True)
+                log.debug(output)
+
+                m = re.match("dpkg-deb: building package \S+ in `(\S+)'",
+                             output)
+                if m and os.path.exists(m.group(1)):
+                    self.filename = os.path.abspath(m.group(1))
+                else:
+                    raise PackagerError("Error creating debian package")
+        finally:
+            # Don't leave DEBIAN behind in rootdir, even if the build failed
+            if os.path.exists(self._debdir()):
+                local("rm -r '%s'" % self._debdir(), capture=False)
 
         if self.lint:
             suppress_tags = self.config.get('package:deb', 'lintian_suppress')
@@ -425,7 +708,7 @@ class RpmPackage(BasePackage):
         rootdir = self.env.rootdir
         config = self.config
 
-        tmpdir = tempfile.mkdtemp(prefix='builder-rpm-')
+        tmpdir = tempfile.mkdtemp(prefix='builder-rpm-', dir=self.scratchdir)
         with open(os.path.join(tmpdir,'package.spec'), 'w') as specfp:
             self._write_rpm_spec(specfp, version)
 
@@ -0,0 +1,384 @@
+# Copyright 2012 Lee Verberne <lee@blarg.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"Run commands on many hosts at once"
+
+import Queue
+import logging
+import select
+import subprocess
+import sys
+import threading
+import time
+
+from fabric.state import connections
+from paramiko.agent import AgentRequestHandler
+
+log = logging.getLogger('ubik.remote')
+
+# fabric's run() and put() work on the global fabric env, which can't be
+# shared between threads.  Instead each thread drives its own host's ssh
+# connection directly, which still comes from (and is cached in) fabric's
+# connection cache.  Connections stay open for the life of the process so
+# that every command rug runs on a host shares one ssh transport.
+
+KEEPALIVE = 30
+STREAM_BUFSIZE = 32*1024
+STREAM_MAX_LINE = 64*1024
+# rsync can't use the connections above, but can share an OpenSSH master
+# connection between calls and between rug invocations
+SSH_CONTROL_OPTS = ('-o ControlMaster=auto -o ControlPersist=60 '
+                    '-o ControlPath=~/.ssh/rug-%r@%h:%p')
+
+_output_lock = threading.Lock()
+
+class RemoteException(Exception):
+    def __init__(self, host_string, command, return_code, output,
+                 message=None):
+        if not message:
+            message = "'%s' exited with status %d" % (command, return_code)
+        super(RemoteException, self).__init__("%s on %s" % (message,
+                                                            host_string))
+        self.host_string = host_string
+        self.command = command
+        self.return_code = return_code
+        self.output = output
+
+def _print(host_string, what, text, out=None):
+    "Print text prefixed by host the way fabric does, one line at a time"
+    out = out or sys.stdout
+    with _output_lock:
+        for line in text.splitlines():
+            print >>out, "[%s] %s: %s" % (host_string, what, line)
+        out.flush()
+
+def _client(host_string):
+    "Return a connected ssh client for host_string from the connection cache"
+    client = connections[host_string]
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        log.debug("Reconnecting to %s", host_string)
+        client.close()
+        del connections[host_string]
+        client = connections[host_string]
+        transport = client.get_transport()
+    transport.set_keepalive(KEEPALIVE)
+    return client
+
+def host_key(host_string):
+    "Return the key of host_string, as 'keytype base64' for known_hosts"
+    key = _client(host_string).get_transport().get_remote_server_key()
+    return "%s %s" % (key.get_name(), key.get_base64())
+
+def disconnect_all():
+    "Close every cached connection"
+    for key in connections.keys():
+        log.debug("Closing connection to %s", key)
+        connections[key].close()
+        del connections[key]
+
+def execute(host_string, command, out=None, forward_agent=False,
+            quiet=False):
+    """Run command on host_string and return its output
+
+    stderr is combined with stdout.  Raises RemoteException if the command
+    exits with a non-zero status.  With forward_agent, the command may use
+    the local ssh agent to connect to other hosts.  With quiet, the command
+    and its output aren't printed.
+    """
+    if not quiet:
+        _print(host_string, 'run', command, out)
+    channel = _client(host_string).get_transport().open_session()
+    try:
+        if forward_agent:
+            AgentRequestHandler(channel)
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        output = channel.makefile('rb', -1).read().rstrip()
+        status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if not quiet:
+        _print(host_string, 'out', output, out)
+    if status != 0:
+        raise RemoteException(host_string, command, status, output)
+    return output
+
+def upload(host_string, localpath, remotepath, out=None):
+    "Copy localpath to remotepath on host_string over sftp"
+    _print(host_string, 'put', "%s -> %s" % (localpath, remotepath), out)
+    sftp = _client(host_string).open_sftp()
+    try:
+        sftp.put(localpath, remotepath)
+    finally:
+        sftp.close()
+
+def sync(host_string, localpath, remotedir, out=None):
+    """Copy localpath into remotedir on host_string with rsync
+
+    rsync sends only the differences from a similarly named file already in
+    remotedir, such as a previous version of a package.  It uses ssh
+    directly, so fabric's connection settings (e.g. passwords) don't apply.
+    """
+    _print(host_string, 'sync', "%s -> %s" % (localpath, remotedir), out)
+    command = ('rsync', '--compress', '--fuzzy', '--times',
+               '--rsh=ssh -o BatchMode=yes ' + SSH_CONTROL_OPTS, localpath,
+               "%s:%s" % (host_string, remotedir))
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0].rstrip()
+    _print(host_string, 'out', output, out)
+    if process.returncode:
+        raise RemoteException(host_string, ' '.join(command),
+                              process.returncode, output)
+
+def stream(host_strings, command, out=None, concurrency=10):
+    """Run command on every host and print its output as it arrives
+
+    Output lines are prefixed by host.  All hosts are read from this thread
+    using select().  While out is blocked, channels aren't read and ssh flow
+    control stops the remote commands once their window is full, so a slow
+    reader never causes unbounded buffering.  Streaming stops when every
+    command exits or on KeyboardInterrupt.  Returns a dict of exit status
+    by host, which is None for commands that didn't exit and -1 for those
+    that couldn't be started.
+    """
+    out = out or sys.stdout
+    channels = {}
+
+    # Connecting is slow, so start the commands from several threads
+    def start(host_string):
+        channel = _client(host_string).get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        channels[channel] = [host_string, '']
+    status = dict.fromkeys(host_strings)
+    for result in run_hosts(host_strings, start, concurrency, False):
+        if not result.ok:
+            _print(result.host, 'error', result.message, out)
+            status[result.host] = -1
+
+    try:
+        while channels:
+            for channel in select.select(channels.keys(), [], [], 1.0)[0]:
+                host_string, partial = channels[channel]
+                data = channel.recv(STREAM_BUFSIZE)
+                if not data:
+                    _print(host_string, 'out', partial, out)
+                    status[host_string] = channel.recv_exit_status()
+                    channel.close()
+                    del channels[channel]
+                    continue
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                if len(partial) > STREAM_MAX_LINE:
+                    lines.append(partial)
+                    partial = ''
+                channels[channel][1] = partial
+                _print(host_string, 'out', '\n'.join(lines), out)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for channel in channels:
+            channel.close()
+    return status
+
+class HostResult(object):
+    "The outcome of running a task on a single host"
+
+    def __init__(self, host):
+        self.host = host
+        self.status = 'skipped'
+        self.return_code = None
+        self.elapsed = 0.0
+        self.message = ''
+
+    def __repr__(self):
+        return "<HostResult %s: %s>" % (self.host, self.status)
+
+    @property
+    def ok(self):
+        return self.status == 'ok'
+
+def _worker(func, work, results, abort, fail_fast):
+    while not abort.is_set():
+        try:
+            index, host = work.get_nowait()
+        except Queue.Empty:
+            return
+        result = results[index]
+        start = time.time()
+        try:
+            result.message = func(host) or ''
+            result.status = 'ok'
+            result.return_code = 0
+        except RemoteException as e:
+            result.status = 'failed'
+            result.return_code = e.return_code
+            result.message = str(e)
+        except Exception as e:
+            log.debug("Task failed on %s", host, exc_info=True)
+            result.status = 'failed'
+            result.message = str(e) or e.__class__.__name__
+        result.elapsed = time.time() - start
+        if not result.ok:
+            log.error("%s failed: %s", host, result.message)
+            if fail_fast:
+                abort.set()
+
+def run_hosts(hosts, func, concurrency=1, fail_fast=True):
+    """Call func(host) for every host, at most concurrency at a time
+
+    Returns a list of HostResult in the same order as hosts.  func may
+    return a message to record in its result.  Exceptions raised by func
+    mark the host failed.  With fail_fast, no new hosts are started after a
+    failure and hosts that never started are left 'skipped'.
+
+    >>> def task(host):
+    ...     if host == 'b':
+    ...         raise Exception("broken")
+    ...     return 'fine'
+    >>> [(r.host, r.status, r.message)
+    ...  for r in run_hosts(['a', 'b', 'c'], task, 1, False)]
+    [('a', 'ok', 'fine'), ('b', 'failed', 'broken'), ('c', 'ok', 'fine')]
+    >>> [r.status for r in run_hosts(['a', 'b', 'c'], task, 1, True)]
+    ['ok', 'failed', 'skipped']
+    >>>
+
+    """
+    results = [HostResult(host) for host in hosts]
+    work = Queue.Queue()
+    for item in enumerate(hosts):
+        work.put(item)
+    abort = threading.Event()
+
+    threads = []
+    for i in range(max(1, min(concurrency, len(hosts)))):
+        thread = threading.Thread(target=_worker,
+                                  args=(func, work, results, abort, fail_fast))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        # join() without a timeout would block KeyboardInterrupt
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        abort.set()
+        raise
+    return results
+
+def batches(hosts, size, key=None):
+    """Split hosts into batches of size for a rolling operation
+
+    size is either a number of hosts or a percentage such as '25%'.  If key
+    is given, hosts are first grouped by key(host) and batches never mix
+    groups, in which case percentages are of each group.
+
+    >>> hosts = ['a.dc1', 'b.dc1', 'c.dc1', 'd.dc2', 'e.dc2']
+    >>> batches(hosts, '2')
+    [['a.dc1', 'b.dc1'], ['c.dc1', 'd.dc2'], ['e.dc2']]
+    >>> batches(hosts, '50%', key=lambda h: h.split('.')[1])
+    [['a.dc1', 'b.dc1'], ['c.dc1'], ['d.dc2'], ['e.dc2']]
+    >>>
+
+    """
+    groups = []
+    if key:
+        index = {}
+        for host in hosts:
+            k = key(host)
+            if k not in index:
+                index[k] = len(groups)
+                groups.append([])
+            groups[index[k]].append(host)
+    else:
+        groups.append(list(hosts))
+
+    size = str(size).strip()
+    result = []
+    for group in groups:
+        if size.endswith('%'):
+            count = -(-len(group) * int(size[:-1]) // 100)
+        else:
+            count = int(size)
+        count = max(1, count)
+        for i in range(0, len(group), count):
+            result.append(group[i:i + count])
+    return result
+
+def wait_for(host_string, command, expect, timeout, interval=2):
+    """Run command on host_string until its output contains expect
+
+    expect may also be a function, which is passed the output and returns
+    True once it's as expected.  Raises RemoteException if expect isn't
+    seen within timeout seconds.
+    """
+    what = expect
+    if callable(expect):
+        what = 'the expected status'
+    else:
+        expect = lambda output, text=expect: text in output
+    deadline = time.time() + timeout
+    while True:
+        try:
+            output = execute(host_string, command)
+            return_code = 0
+        except RemoteException as e:
+            output = e.output
+            return_code = e.return_code
+        if expect(output):
+            return output
+        if time.time() >= deadline:
+            raise RemoteException(host_string, command, return_code, output,
+                                  "'%s' did not report %s within %ds" %
+                                  (command, what, timeout))
+        time.sleep(interval)
+
+def print_summary(results, out=None):
+    """Print a table of the status and timing of each HostResult
+
+    >>> r = HostResult('host1.dc1')
+    >>> r.status, r.return_code, r.elapsed = 'failed', 1, 2.5
+    >>> print_summary([r, HostResult('host2.dc1')])
+    HOST                           STATUS    EXIT     TIME  MESSAGE
+    host1.dc1                      failed       1     2.5s
+    host2.dc1                      skipped      -     0.0s
+    0 ok, 1 failed, 1 skipped
+    >>>
+
+    """
+    out = out or sys.stdout
+    print >>out, "%-30s %-8s %5s %8s  %s" % ('HOST', 'STATUS', 'EXIT', 'TIME',
+                                            'MESSAGE')
+    for r in results:
+        code = '-' if r.return_code is None else r.return_code
+        line = "%-30s %-8s %5s %7.1fs  %s" % (r.host, r.status, code,
+                                              r.elapsed,
+                                              r.message.splitlines()[0]
+                                              if r.message else '')
+        print >>out, line.rstrip()
+    counts = dict.fromkeys(('ok', 'failed', 'skipped'), 0)
+    for r in results:
+        counts[r.status] = counts.get(r.status, 0) + 1
+    print >>out, "%d ok, %d failed, %d skipped" % (counts['ok'],
+                                                   counts['failed'],
+                                                   counts['skipped'])
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
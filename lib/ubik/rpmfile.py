@@ -0,0 +1,100 @@
+# Copyright 2012 Lee Verberne <lee@blarg.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"Pure python reading of rpm package headers"
+
+import logging
+import struct
+
+log = logging.getLogger('ubik.rpmfile')
+
+LEAD_MAGIC = '\xed\xab\xee\xdb'
+LEAD_SIZE = 96
+HEADER_MAGIC = '\x8e\xad\xe8\x01'
+
+# Header tags and types this module understands
+TAGS = {
+    1000: 'NAME',
+    1001: 'VERSION',
+    1002: 'RELEASE',
+    1003: 'EPOCH',
+    1022: 'ARCH',
+}
+TYPE_INT32 = 4
+TYPE_STRING = 6
+TYPE_I18NSTRING = 9
+
+class RpmFileError(Exception):
+    pass
+
+def _read_header(rpm, what):
+    "Read a header structure, returning its index entries and data store"
+    intro = rpm.read(16)
+    if len(intro) < 16 or intro[:4] != HEADER_MAGIC:
+        raise RpmFileError("Bad %s header" % what)
+    count, size = struct.unpack('>II', intro[8:])
+    index = rpm.read(count * 16)
+    store = rpm.read(size)
+    if len(index) < count * 16 or len(store) < size:
+        raise RpmFileError("Truncated %s header" % what)
+    entries = [struct.unpack('>iIiI', index[i:i + 16])
+               for i in range(0, len(index), 16)]
+    return entries, store
+
+def read_header(rpmpath):
+    """Return the NAME, VERSION, RELEASE, EPOCH and ARCH of an rpm package
+
+    Only the lead, signature and main header are read.  Tags missing from
+    the package are missing from the returned dictionary.
+
+    >>> sorted(read_header('tests/testpkg-1.0-2.noarch.rpm').items())
+    ... #doctest: +NORMALIZE_WHITESPACE
+    [('ARCH', 'noarch'), ('EPOCH', 1), ('NAME', 'testpkg'), ('RELEASE', '2'),
+     ('VERSION', '1.0')]
+    >>> read_header('tests/testpkg_1.0_all.deb')
+    Traceback (most recent call last):
+        ...
+    RpmFileError: Not an rpm package: tests/testpkg_1.0_all.deb
+    >>>
+
+    """
+    with open(rpmpath, 'rb') as rpm:
+        lead = rpm.read(LEAD_SIZE)
+        if len(lead) < LEAD_SIZE or lead[:4] != LEAD_MAGIC:
+            raise RpmFileError("Not an rpm package: " + rpmpath)
+
+        # The signature header is padded to a multiple of 8 bytes
+        entries, store = _read_header(rpm, 'signature')
+        rpm.read(-len(store) % 8)
+        entries, store = _read_header(rpm, 'main')
+
+    fields = {}
+    for tag, type, offset, count in entries:
+        if tag not in TAGS:
+            continue
+        if type == TYPE_INT32:
+            value = struct.unpack('>i', store[offset:offset + 4])[0]
+        elif type in (TYPE_STRING, TYPE_I18NSTRING):
+            value = store[offset:store.index('\0', offset)]
+        else:
+            raise RpmFileError("Unexpected type %d for tag %d in %s" %
+                               (type, tag, rpmpath))
+        fields[TAGS[tag]] = value
+    log.debug("Read header of %s: %s", rpmpath, fields)
+    return fields
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS, verbose=False)
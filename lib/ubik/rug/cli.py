@@ -81,6 +81,8 @@ def main(args=None):
             if options.debug:
                 raise e
             return 1
+        finally:
+            hat.close()
     else:
         print >>sys.stderr, "ERROR: No such command"
         return 2